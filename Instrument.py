@@ -0,0 +1,221 @@
+# Description
+# Time the stages of the insert and extract routines and count the work they do, so slow runs can be pulled apart stage by stage.
+#
+# Spans:
+#   span(name) is used as a with block around a stage and records how long the stage took, the span it ran inside and
+#   whether it raised.  traced(name) does the same for a whole routine and records the status code the routine returned.
+#   The cipher text is made while the image is being encoded, and read out of the image while it is being decrypted,
+#   so timedChunks records the time spent pulling chunks out of a generator as a span of its own.  That time is also
+#   part of the span the chunks are pulled inside of.
+#
+# Counters:
+#   count(name, amount) records an amount of work, such as the pixels touched, the bits embedded or the bytes encrypted.
+#
+# Sinks:
+#   Every record is a dictionary handed to the write method of the sink set with setSink.
+#   JsonLinesSink appends each record to a file as a line of JSON, MemorySink keeps the records and adds up the spans and counters.
+#   Setting the HIDDEN_TRACE environment variable to a file name writes the records of every process to that file.
+#   Without a sink nothing is timed or recorded: span hands back one shared do nothing span and count returns straight away.
+
+
+import json
+import os
+import threading
+import time
+
+
+# Environment variable naming a JSON lines file to write the records to
+TRACE_ENV = "HIDDEN_TRACE"
+
+# Where the records go, None while instrumentation is turned off
+sink = None
+
+# The spans open on each thread, innermost last
+openSpans = threading.local()
+
+
+class NullSpan(object):
+    """ Span handed out while instrumentation is turned off, it records nothing """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+    def set(self, name, value):
+        pass
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    """ Time a with block and write a span record for it when it ends """
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        stack = spanStack()
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        seconds = time.time() - self.start
+        spanStack().pop()
+        record = {"type": "span", "name": self.name, "parent": self.parent, "start": self.start, "seconds": seconds}
+        if excType != None:
+            record["error"] = excType.__name__
+        record.update(self.fields)
+        emit(record)
+        return False
+
+    def set(self, name, value):
+        """ Add a field to the span record """
+        self.fields[name] = value
+
+
+def spanStack():
+    """ The spans open on this thread """
+    stack = getattr(openSpans, "stack", None)
+    if stack == None:
+        stack = openSpans.stack = []
+    return stack
+
+
+def emit(record):
+    """ Hand a record to the sink, tagged with the process it came from """
+    current = sink
+    if current != None:
+        record["pid"] = os.getpid()
+        current.write(record)
+
+
+def setSink(newSink):
+    """ Send the records to newSink, or turn instrumentation off with None.  Returns the sink that was set before. """
+    global sink
+    oldSink = sink
+    sink = newSink
+    return oldSink
+
+
+def span(name, **fields):
+    """ Span timing a with block, any keyword arguments are added to its record """
+    if sink == None:
+        return NULL_SPAN
+    return Span(name, fields)
+
+
+def count(name, amount):
+    """ Record an amount of work done inside the current span """
+    if sink == None:
+        return
+    stack = spanStack()
+    emit({"type": "count", "name": name, "value": amount, "parent": stack[-1].name if stack else None})
+
+
+def traced(name):
+    """ Decorator timing every call of a routine as a span, with the status code the routine returned """
+    def decorate(routine):
+        def tracedRoutine(*args, **kwargs):
+            if sink == None:
+                return routine(*args, **kwargs)
+            with Span(name, {}) as current:
+                status = routine(*args, **kwargs)
+                current.set("status", status)
+                return status
+        tracedRoutine.__name__ = routine.__name__
+        tracedRoutine.__doc__ = routine.__doc__
+        return tracedRoutine
+    return decorate
+
+
+def timedChunks(name, chunks):
+    """ Hand back the chunks, recording the time spent making them and their number and bytes as a span.
+        Without a sink the chunks are handed back untouched."""
+    if sink == None:
+        return chunks
+    return timeChunks(name, chunks)
+
+
+def timeChunks(name, chunks):
+    """ Generator behind timedChunks, the span is written once the chunks run out or the consumer stops pulling on them """
+    stack = spanStack()
+    parent = stack[-1].name if stack else None
+    began = start = time.time()
+    seconds = 0.0
+    made = 0
+    size = 0
+    try:
+        for chunk in chunks:
+            seconds += time.time() - start
+            made += 1
+            size += len(chunk)
+            yield chunk
+            start = time.time()
+        seconds += time.time() - start
+    finally:
+        emit({"type": "span", "name": name, "parent": parent, "start": began, "seconds": seconds, "chunks": made, "bytes": size})
+
+
+class JsonLinesSink(object):
+    """ Append every record to a file as one line of JSON.
+        Each process opens the file for itself, so worker processes started from this one write whole lines of their own."""
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.lock = threading.Lock()
+        self.fOut = None
+        self.pid = None
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self.lock:
+            if self.pid != os.getpid():
+                self.fOut = open(self.fileName, "ab")
+                self.pid = os.getpid()
+            self.fOut.write(line)
+            self.fOut.flush()
+
+    def close(self):
+        with self.lock:
+            if self.fOut != None and self.pid == os.getpid():
+                self.fOut.close()
+            self.fOut = None
+
+
+class MemorySink(object):
+    """ Keep every record in memory """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+
+    def write(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def spans(self, name):
+        """ Seconds taken by every span with the given name, in the order they ended """
+        with self.lock:
+            return [record["seconds"] for record in self.records if record["type"] == "span" and record["name"] == name]
+
+    def totals(self):
+        """ Total seconds of the spans and total amount of the counters, by name """
+        totals = {}
+        with self.lock:
+            for record in self.records:
+                value = record["seconds"] if record["type"] == "span" else record["value"]
+                totals[record["name"]] = totals.get(record["name"], 0) + value
+        return totals
+
+    def clear(self):
+        with self.lock:
+            del self.records[:]
+
+
+if os.environ.get(TRACE_ENV):
+    sink = JsonLinesSink(os.environ[TRACE_ENV])
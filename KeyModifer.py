@@ -15,18 +15,92 @@
 # 2) Scramble the prime matrix, then multiply the prime matrix and pin matrix.
 # 3) Take the inverse of the prime/pin matrix and multiply it with the storage key matrix.
 # 4) Unscrambling the key matrix and convert it back into a list of numbers. 
+#
+# All of the matrix math is done with Python integers so a masked key always unmasks to exactly the key seed it came from.
+# The prime/pin matrix is inverted through its adjugate and determinant: inverse(A) = adjugate(A) / determinant(A).
+# Storage keys made with the old floating point inverse that do not divide out evenly are unmasked with that same floating point path.
+#
+# Pin cache:
+# Everything unMaskKey computes besides the storage key matrix only depends on the pin, so it is cached per pin.
+# The cache holds key material, so entries are overwritten when they are evicted and clearPinCache can wipe it at any time.
+# It keeps at most PIN_CACHE_SIZE pins, and a pin that hasn't been used for PIN_CACHE_TTL seconds is evicted the next time the
+# cache is used, so a long running batch or service only keeps the pins it is still being handed.
+#
+# Batches:
+# maskKeys and unMaskKeys run the same steps on stacks of key seeds and pins as (N, 4, 4) array operations.
+# The row and column swaps of the scramble steps are turned into index permutations, and the 4X4 adjugates are built
+# from 2X2 sub-determinants of every matrix in the stack at once.
+# A pin that isn't invertable only fails its own key, which unMaskKeys hands back as None.
 
 
+import collections
+import hashlib
 import os
+import threading
+import time
 import numpy
 
 
+# Number of pins whose prime/pin matrix inverse is kept by unMaskKey, 0 turns the cache off
+PIN_CACHE_SIZE = 16
+
+# Seconds a cached pin is kept after it was last used, 0 keeps it until it is pushed out by newer pins
+PIN_CACHE_TTL = 300
+
+pinCache = collections.OrderedDict()
+pinCacheLock = threading.Lock()
+pinCacheStats = {"hits": 0, "misses": 0, "evictions": 0}
+
+PRIMES_LIST = [999425970427, 927425969867, 327425970031, 762475413737, 441349, 325861, 785597, 165541, 7640287, 2168377, 9396271, 94113661, 37814797, 378135293, 624938047, 2624756177]
+
+
 def invertable(pin):
     """ Test if the provided pin is invertable """
 
     pinOffset = ((sum(pin))/len(pin))%16
     pinMatrix = convertIntoMatrix(pin, pinOffset)
-    return numpy.linalg.det(pinMatrix) == 0
+    return determinant(pinMatrix.tolist()) == 0
+
+
+def keyOffsets(pin):
+    """ Calcute the key seed, prime matrix and pin offsets for the provided pin """
+
+    primesList = PRIMES_LIST
+    pinSum = sum(pin)
+    pinLength = len(pin)
+    keySeedOffset = ((pinSum+(primesList[3]*primesList[1]))/pinLength)%16
+    primeMatrixOffset = ((pinSum+(primesList[5]*primesList[15]))/pinLength)%16
+    pinOffset = ((pinSum)/pinLength)%16
+    return keySeedOffset, primeMatrixOffset, pinOffset
+
+
+def determinant(A):
+    """ Exact determinant of a square matrix given as a list of rows, by cofactor expansion along the first row """
+
+    if len(A) == 1:
+        return A[0][0]
+
+    total = 0
+    for j in range(len(A)):
+        total += (-1) ** j * A[0][j] * determinant(minorMatrix(A, 0, j))
+    return total
+
+
+def minorMatrix(A, row, column):
+    """ Return the list of rows A without the given row and column """
+    return [A[i][:column] + A[i][column + 1:] for i in range(len(A)) if i != row]
+
+
+def adjugate(A):
+    """ Exact adjugate of a square matrix given as a list of rows, the transposed matrix of cofactors """
+
+    size = len(A)
+    return [[(-1) ** (i + j) * determinant(minorMatrix(A, j, i)) for j in range(size)] for i in range(size)]
+
+
+def exactMatrix(A):
+    """ Convert a numpy matrix into an object matrix of Python integers so products never overflow or round """
+    return numpy.array(A.tolist(), dtype=object)
 
 
 def convertIntoMatrix(listIn, offset):
@@ -75,7 +149,10 @@ def convertIntoList(A, offset):
         row = A[[i]]
         
         for j in range(4):
-            tempList.append(int(round(row[0][j])))
+            value = row[0][j]
+            if isinstance(value, (float, numpy.floating)):
+                value = round(value)
+            tempList.append(int(value))
 
     outList = []
     for i in range(16):
@@ -164,29 +241,25 @@ def maskKey(keySeedMatrix, pin):
     
     """
 
-    primesList = [999425970427, 927425969867, 327425970031, 762475413737, 441349, 325861, 785597, 165541, 7640287, 2168377, 9396271, 94113661, 37814797, 378135293, 624938047, 2624756177]
+    primesList = PRIMES_LIST
 
     # 1)
     # ---------------------------------------------------------------------------------------------
-    pinSum = sum(pin)
-    pinLength = len(pin)
-    keySeedOffset = ((pinSum+(primesList[3]*primesList[1]))/pinLength)%16
-    primeMatrixOffset = ((pinSum+(primesList[5]*primesList[15]))/pinLength)%16
-    pinOffset = ((pinSum)/pinLength)%16
+    keySeedOffset, primeMatrixOffset, pinOffset = keyOffsets(pin)
 
     
-    pinMatrix = convertIntoMatrix(pin, pinOffset)
+    pinMatrix = exactMatrix(convertIntoMatrix(pin, pinOffset))
     
     # Check if the pin isn't invertable
-    if numpy.linalg.det(pinMatrix) == 0:
+    if determinant(pinMatrix.tolist()) == 0:
         print
         print "This pin will not work"
         print "Please try another"
         return 'f', keySeedMatrix
                     
 
-    keySeedMatrix = convertIntoMatrix(keySeedMatrix, keySeedOffset)
-    primeMatrix = convertIntoMatrix(primesList, primeMatrixOffset)
+    keySeedMatrix = exactMatrix(convertIntoMatrix(keySeedMatrix, keySeedOffset))
+    primeMatrix = exactMatrix(convertIntoMatrix(primesList, primeMatrixOffset))
 
 
     # 2)
@@ -202,39 +275,339 @@ def maskKey(keySeedMatrix, pin):
     return 't', convertIntoList(storageKeyMatrix, 0)
     
 
+def pinInverse(pin):
+    """ Work out everything unMaskKey needs that only depends on the pin.
+
+    Steps:
+    1) Calcute the offsets for the pin, and convert the pin and primes into matrices.
+    2) Scramble the prime matrix, then multiply the prime matrix and pin matrix.
+    3) Take the adjugate and determinant of the prime/pin matrix, which together make up its inverse.
+
+    The results are kept in a small least recently used cache keyed by a hash of the pin, as images are often unmasked with the same pin.
+    """
+
+    cacheKey = hashlib.sha256(",".join(str(value) for value in pin)).hexdigest()
+    with pinCacheLock:
+        expireEntries()
+        if cacheKey in pinCache:
+            pinCacheStats["hits"] += 1
+            entry = pinCache.pop(cacheKey)
+            entry["used"] = time.time()
+            pinCache[cacheKey] = entry
+            return readEntry(entry)
+        pinCacheStats["misses"] += 1
+
+    # 1)
+    # ---------------------------------------------------------------------------------------------
+    keySeedOffset, primeMatrixOffset, pinOffset = keyOffsets(pin)
+    pinMatrix = exactMatrix(convertIntoMatrix(pin, pinOffset))
+    primeMatrix = exactMatrix(convertIntoMatrix(PRIMES_LIST, primeMatrixOffset))
+
+    # 2)
+    # ---------------------------------------------------------------------------------------------
+    primeMatrix = scrambleMatrix(primeMatrix, ((pinOffset + primeMatrixOffset)%3), 't')
+    pinMatrix = primeMatrix.dot(pinMatrix)
+
+    # 3)
+    # ---------------------------------------------------------------------------------------------
+    entry = {"offsets": [keySeedOffset, primeMatrixOffset, pinOffset],
+             "pinMatrix": pinMatrix,
+             "adjugate": numpy.array(adjugate(pinMatrix.tolist()), dtype=object),
+             "determinant": numpy.array([determinant(pinMatrix.tolist())], dtype=object),
+             "used": time.time()}
+
+    with pinCacheLock:
+        if PIN_CACHE_SIZE > 0:
+            pinCache[cacheKey] = entry
+            while len(pinCache) > PIN_CACHE_SIZE:
+                wipeEntry(pinCache.popitem(last=False)[1])
+                pinCacheStats["evictions"] += 1
+        return readEntry(entry)
+
+
+def expireEntries():
+    """ Evict and wipe the pins that haven't been used for PIN_CACHE_TTL seconds, the caller holds pinCacheLock.
+        The least recently used pins come first, so the search stops at the first pin that is still fresh."""
+    if PIN_CACHE_TTL <= 0:
+        return
+    oldest = time.time() - PIN_CACHE_TTL
+    while pinCache and next(pinCache.itervalues())["used"] < oldest:
+        wipeEntry(pinCache.popitem(last=False)[1])
+        pinCacheStats["evictions"] += 1
+
+
+def readEntry(entry):
+    """ Copy the offsets, prime/pin matrix, adjugate and determinant out of a pin cache entry, so a later wipe can't change them """
+    return tuple(entry["offsets"]) + (entry["pinMatrix"].copy(), entry["adjugate"].copy(), entry["determinant"][0])
+
+
+def wipeEntry(entry):
+    """ Overwrite the key material held by a pin cache entry """
+    entry["offsets"][:] = [0, 0, 0]
+    entry["pinMatrix"].fill(0)
+    entry["adjugate"].fill(0)
+    entry["determinant"].fill(0)
+
+
+def evictPin(pin):
+    """ Remove and wipe the cache entry of one pin, returns True when the pin was cached """
+    cacheKey = hashlib.sha256(",".join(str(value) for value in pin)).hexdigest()
+    with pinCacheLock:
+        entry = pinCache.pop(cacheKey, None)
+        if entry == None:
+            return False
+        wipeEntry(entry)
+        pinCacheStats["evictions"] += 1
+        return True
+
+
+def clearPinCache(wipe=True):
+    """ Empty the pin cache, overwriting the cached matrices first unless wipe is False """
+    with pinCacheLock:
+        while pinCache:
+            entry = pinCache.popitem()[1]
+            if wipe:
+                wipeEntry(entry)
+
+
+def getPinCacheStats():
+    """ Return the pin cache hit, miss and eviction counters along with its current size """
+    with pinCacheLock:
+        expireEntries()
+        stats = dict(pinCacheStats)
+        stats["size"] = len(pinCache)
+        return stats
+
+
 def unMaskKey(storageKey, pin):
     """ Convert the StorageKey back into its original form.  
 
         Perfrom these three steps to rebuild the original key's seed:
-        1) Calcute an offset for the three list, that way when converted into a matrix the list and matrix do not line up.
-        2) Scramble the prime matrix. 
+        1) Look up the offsets and the inverse of the scrambled prime/pin matrix for the pin, see pinInverse.
+        2) Convert the storage key into a matrix.
         3) prefrom this calculation: inverse(Pmatrix X PINmatrix) X KEYmatrix = StorageMatrix.  Return the StorageMatrix to the caller.
+           The inverse is taken as adjugate / determinant with exact integers.
+           Storage keys that do not divide evenly by the determinant were made by the old floating point routine and are unmasked with it.
+           A pin that isn't invertable has a determinant of 0 and goes to the floating point routine too, which raises numpy.linalg.LinAlgError.
         4) Unscramble the key matrix, and return it in list from.
     """
-    
-    primesList = [999425970427, 927425969867, 327425970031, 762475413737, 441349, 325861, 785597, 165541, 7640287, 2168377, 9396271, 94113661, 37814797, 378135293, 624938047, 2624756177]
-
-
-    pinSum = sum(pin)
-    pinLength = len(pin)
-    keySeedOffset = ((pinSum+(primesList[3]*primesList[1]))/pinLength)%16
-    primeMatrixOffset = ((pinSum+(primesList[5]*primesList[15]))/pinLength)%16
-    pinOffset = ((pinSum)/pinLength)%16
 
-    # Convert the pin, primes, and storage key into matrices
-    pinMatrix = convertIntoMatrix(pin, pinOffset)
-    primeMatrix = convertIntoMatrix(primesList, primeMatrixOffset)
-    storageKeyMatrix = convertIntoMatrix(storageKey, 0)
+    # 1)
+    # ---------------------------------------------------------------------------------------------
+    keySeedOffset, primeMatrixOffset, pinOffset, pinMatrix, adjugateMatrix, pinDeterminant = pinInverse(pin)
 
+    # 2)
+    # ---------------------------------------------------------------------------------------------
+    storageKeyMatrix = exactMatrix(convertIntoMatrix(storageKey, 0))
 
-    primeMatrix = scrambleMatrix(primeMatrix, ((pinOffset + primeMatrixOffset)%3), 't')
-    pinMatrix = primeMatrix.dot(pinMatrix)
+    # 3)
+    # ---------------------------------------------------------------------------------------------
+    keySeedMatrix = adjugateMatrix.dot(storageKeyMatrix)
 
-    inversePinMatrix = numpy.linalg.inv(pinMatrix)
+    if pinDeterminant == 0 or any(value % pinDeterminant != 0 for value in keySeedMatrix.flat):
+        inversePinMatrix = numpy.linalg.inv(pinMatrix.astype(float))
+        keySeedMatrix = inversePinMatrix.dot(storageKeyMatrix.astype(float))
+    else:
+        keySeedMatrix = keySeedMatrix // pinDeterminant
 
-    keySeedMatrix = inversePinMatrix.dot(storageKeyMatrix)
+    # 4)
+    # ---------------------------------------------------------------------------------------------
     keySeedMatrix = unscrambleMatrix(keySeedMatrix, ((pinOffset + primeMatrixOffset)%4), 'f')
 
     keySeed = convertIntoList(keySeedMatrix, keySeedOffset)
 
     return keySeed
+
+
+def checkMask(keySeed, storageKey, pin):
+    """ Check that the storage key unmasks back into the key seed, without touching any files """
+    try:
+        return unMaskKey(storageKey, pin) == list(keySeed)
+    except:
+        return False
+
+
+def scramblePermutation(mixNumber, primeMix, unscramble):
+    """ Return the row order and column order that scrambleMatrix (or unscrambleMatrix) would leave a matrix in """
+
+    index = numpy.arange(16).reshape(4, 4)
+    if unscramble:
+        index = unscrambleMatrix(index, mixNumber, primeMix)
+    else:
+        index = scrambleMatrix(index, mixNumber, primeMix)
+    return index[:, 0] // 4, index[0, :] % 4
+
+
+def scrambleMatrices(A, mixNumbers, primeMix, unscramble):
+    """ Scramble (or unscramble) every matrix in the (N, 4, 4) stack A by its own mixing number """
+
+    rowOrders = numpy.zeros((len(A), 4), dtype=numpy.intp)
+    columnOrders = numpy.zeros((len(A), 4), dtype=numpy.intp)
+    for mixNumber in range(4):
+        rowOrder, columnOrder = scramblePermutation(mixNumber, primeMix, unscramble)
+        rowOrders[mixNumbers == mixNumber] = rowOrder
+        columnOrders[mixNumbers == mixNumber] = columnOrder
+
+    stack = numpy.arange(len(A))[:, None, None]
+    return A[stack, rowOrders[:, :, None], columnOrders[:, None, :]]
+
+
+def convertIntoMatrices(lists, offsets):
+    """ Convert every list of 16 numbers in the (N, 16) array into a 4X4 matrix, starting at its own offset """
+
+    index = (offsets[:, None] + numpy.arange(16)) % 16
+    return lists[numpy.arange(len(lists))[:, None], index].reshape(-1, 4, 4)
+
+
+def multiplyMatrices(A, B):
+    """ Multiply every pair of matrices in the (N, 4, 4) stacks A and B, this works for integer and object arrays """
+    return (A[:, :, :, None] * B[:, None, :, :]).sum(axis=2)
+
+
+def adjugates(A):
+    """ Exact adjugates and determinants of every matrix in the (N, 4, 4) object stack A
+
+    Each cofactor is built from the six 2X2 sub-determinants of the top two rows and of the bottom two rows.
+    """
+
+    a = [[A[:, i, j] for j in range(4)] for i in range(4)]
+
+    s0 = a[0][0]*a[1][1] - a[1][0]*a[0][1]
+    s1 = a[0][0]*a[1][2] - a[1][0]*a[0][2]
+    s2 = a[0][0]*a[1][3] - a[1][0]*a[0][3]
+    s3 = a[0][1]*a[1][2] - a[1][1]*a[0][2]
+    s4 = a[0][1]*a[1][3] - a[1][1]*a[0][3]
+    s5 = a[0][2]*a[1][3] - a[1][2]*a[0][3]
+
+    c5 = a[2][2]*a[3][3] - a[3][2]*a[2][3]
+    c4 = a[2][1]*a[3][3] - a[3][1]*a[2][3]
+    c3 = a[2][1]*a[3][2] - a[3][1]*a[2][2]
+    c2 = a[2][0]*a[3][3] - a[3][0]*a[2][3]
+    c1 = a[2][0]*a[3][2] - a[3][0]*a[2][2]
+    c0 = a[2][0]*a[3][1] - a[3][0]*a[2][1]
+
+    determinants = s0*c5 - s1*c4 + s2*c3 + s3*c2 - s4*c1 + s5*c0
+
+    adjugate = [
+        [a[1][1]*c5 - a[1][2]*c4 + a[1][3]*c3, -a[0][1]*c5 + a[0][2]*c4 - a[0][3]*c3, a[3][1]*s5 - a[3][2]*s4 + a[3][3]*s3, -a[2][1]*s5 + a[2][2]*s4 - a[2][3]*s3],
+        [-a[1][0]*c5 + a[1][2]*c2 - a[1][3]*c1, a[0][0]*c5 - a[0][2]*c2 + a[0][3]*c1, -a[3][0]*s5 + a[3][2]*s2 - a[3][3]*s1, a[2][0]*s5 - a[2][2]*s2 + a[2][3]*s1],
+        [a[1][0]*c4 - a[1][1]*c2 + a[1][3]*c0, -a[0][0]*c4 + a[0][1]*c2 - a[0][3]*c0, a[3][0]*s4 - a[3][1]*s2 + a[3][3]*s0, -a[2][0]*s4 + a[2][1]*s2 - a[2][3]*s0],
+        [-a[1][0]*c3 + a[1][1]*c1 - a[1][2]*c0, a[0][0]*c3 - a[0][1]*c1 + a[0][2]*c0, -a[3][0]*s3 + a[3][1]*s1 - a[3][2]*s0, a[2][0]*s3 - a[2][1]*s1 + a[2][2]*s0]]
+
+    return numpy.stack([numpy.stack(row, axis=1) for row in adjugate], axis=1), determinants
+
+
+def batchOffsets(pins):
+    """ Offsets for every pin in the (N, 16) array, as three integer arrays """
+    offsets = numpy.array([keyOffsets([int(value) for value in pin]) for pin in pins], dtype=numpy.intp).reshape(-1, 3)
+    return offsets[:, 0], offsets[:, 1], offsets[:, 2]
+
+
+def maskKeys(keySeeds, pins):
+    """ Mask a stack of key seeds, the batch form of maskKey.
+
+    keySeeds is a list or array of N key seeds, pins is either one pin used for every key seed or a list of N pins.
+    Returns a list of 't'/'f' flags and a list of storage keys.  The storage key of a pin that isn't invertable is its key seed, like maskKey.
+    
+    Steps:
+    1) Calcute the offsets for every pin and convert the pins, key seeds and primes into (N, 4, 4) stacks.
+    2) Scramble the key matrices and the prime matrices.
+    3) prefrom this calculation for the whole stack: Pmatrix X PINmatrix X KEYmatrix = StorageMatrix.
+    """
+
+    # 1)
+    # ---------------------------------------------------------------------------------------------
+    keySeeds = numpy.array(keySeeds, dtype=numpy.int64).reshape(-1, 16)
+    pins = numpy.broadcast_to(numpy.array(pins, dtype=numpy.int64).reshape(-1, 16), keySeeds.shape)
+    count = len(keySeeds)
+    keySeedOffsets, primeMatrixOffsets, pinOffsets = batchOffsets(pins)
+
+    # Products stay below 2**63 while the pin and key seed values are bytes, bigger values fall back to Python integers
+    dtype = numpy.int64
+    if count and (pins.max() > 255 or keySeeds.max() > 255 or min(pins.min(), keySeeds.min()) < 0):
+        dtype = object
+
+    pinMatrices = convertIntoMatrices(pins, pinOffsets).astype(dtype)
+    keySeedMatrices = convertIntoMatrices(keySeeds, keySeedOffsets).astype(dtype)
+    primeMatrices = convertIntoMatrices(numpy.broadcast_to(numpy.array(PRIMES_LIST, dtype=numpy.int64), (count, 16)), primeMatrixOffsets).astype(dtype)
+
+    # 2)
+    # ---------------------------------------------------------------------------------------------
+    keySeedMatrices = scrambleMatrices(keySeedMatrices, (pinOffsets + primeMatrixOffsets) % 4, 'f', False)
+    primeMatrices = scrambleMatrices(primeMatrices, (pinOffsets + primeMatrixOffsets) % 3, 't', False)
+
+    # 3)
+    # ---------------------------------------------------------------------------------------------
+    storageKeyMatrices = multiplyMatrices(multiplyMatrices(primeMatrices, pinMatrices), keySeedMatrices)
+    storageKeys = [[int(value) for value in row] for row in storageKeyMatrices.reshape(-1, 16).tolist()]
+
+    pinDeterminants = adjugates(pinMatrices.astype(object))[1]
+    flags = []
+    for i in range(count):
+        if pinDeterminants[i] == 0:
+            flags.append('f')
+            storageKeys[i] = keySeeds[i].tolist()
+        else:
+            flags.append('t')
+
+    return flags, storageKeys
+
+
+def unMaskKeys(storageKeys, pins):
+    """ Convert a stack of storage keys back into their key seeds, the batch form of unMaskKey.
+
+    storageKeys is a list of N storage keys, pins is either one pin used for every storage key or a list of N pins.
+    Returns a list of key seeds, with None in place of the key seed of a pin that isn't invertable, so one bad pin doesn't fail the batch.
+    
+    Steps:
+    1) Calcute the offsets for every pin and convert the pins, primes, and storage keys into (N, 4, 4) stacks.
+    2) Scramble the prime matrices and multiply them with the pin matrices.
+    3) inverse(Pmatrix X PINmatrix) X KEYmatrix for the whole stack, with the adjugates and determinants.
+       Storage keys from the old floating point routine that do not divide evenly, and those of pins that aren't invertable,
+       are handed to unMaskKey one at a time.
+    4) Unscramble the key matrices and return them in list from.
+    """
+
+    # 1)
+    # ---------------------------------------------------------------------------------------------
+    storageKeys = numpy.array([[int(value) for value in storageKey] for storageKey in storageKeys], dtype=object).reshape(-1, 16)
+    pins = numpy.broadcast_to(numpy.array(pins, dtype=numpy.int64).reshape(-1, 16), storageKeys.shape)
+    count = len(storageKeys)
+    keySeedOffsets, primeMatrixOffsets, pinOffsets = batchOffsets(pins)
+
+    pinMatrices = convertIntoMatrices(pins, pinOffsets).astype(object)
+    primeMatrices = convertIntoMatrices(numpy.broadcast_to(numpy.array(PRIMES_LIST, dtype=object), (count, 16)), primeMatrixOffsets)
+    storageKeyMatrices = storageKeys.reshape(-1, 4, 4)
+
+    # 2)
+    # ---------------------------------------------------------------------------------------------
+    primeMatrices = scrambleMatrices(primeMatrices, (pinOffsets + primeMatrixOffsets) % 3, 't', False)
+    pinMatrices = multiplyMatrices(primeMatrices, pinMatrices)
+
+    # 3)
+    # ---------------------------------------------------------------------------------------------
+    adjugateMatrices, pinDeterminants = adjugates(pinMatrices)
+    keySeedMatrices = multiplyMatrices(adjugateMatrices, storageKeyMatrices)
+
+    # A determinant of 0 is swapped for 1 so the stack can be divided, its keys are left for unMaskKey
+    singular = numpy.array([value == 0 for value in pinDeterminants], dtype=bool)
+    divisors = numpy.where(singular, 1, pinDeterminants)
+    exact = (keySeedMatrices % divisors[:, None, None] == 0).reshape(-1, 16).all(axis=1) & ~singular
+    keySeedMatrices[exact] = keySeedMatrices[exact] // divisors[exact][:, None, None]
+
+    # 4)
+    # ---------------------------------------------------------------------------------------------
+    keySeedMatrices = scrambleMatrices(keySeedMatrices, (pinOffsets + primeMatrixOffsets) % 4, 'f', True)
+    index = (numpy.arange(16) - keySeedOffsets[:, None]) % 16
+    keySeeds = keySeedMatrices.reshape(-1, 16)[numpy.arange(count)[:, None], index]
+
+    keySeedList = []
+    for i in range(count):
+        if exact[i]:
+            keySeedList.append([int(value) for value in keySeeds[i]])
+        else:
+            try:
+                keySeedList.append(unMaskKey(storageKeys[i].tolist(), pins[i].tolist()))
+            except numpy.linalg.LinAlgError:
+                keySeedList.append(None)
+    return keySeedList
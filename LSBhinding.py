@@ -15,6 +15,11 @@
 # For the info bits look at the end bit of the green light bit pattern, which corresponds to bit 48, if it is a 0 or 1 we replace it with one bit from the info string. 
 # Repeat this process until all message bits and info bits have been encoded into the image.
 #
+# Replacing the last bit of a color's decimal text bit pattern flips the parity of its last digit, which is the same as replacing the color's lowest bit.
+# So the encoder rewrites the blue and green lowest bits with NumPy array operations, a strip of rows at a time.
+# Only the rows carrying bits are copied out of the image and pasted back in place, the rest of the image is never copied,
+# so the memory used stays close to the size of the decoded image no matter how large it is.
+#
 # Decoding:
 # To decode a stego image the reverse the encoding is basically done.
 # Reading the image pixel by pixel we convert the three light color values into binary bit patterns.
@@ -23,228 +28,721 @@
 # Stop pulling bits from the green light once the fifteen 1's and one 0 delimiter of the info bit string had been hit.
 # Stop pulling bits from the blue light once the fifteen 1's and one 0 delimiter of the message bit string has been hit.
 # Convert the two bit pattern minus the delimiter back into ascii characters to create the original two character string.
+#
+# The decoder pulls the blue and green lowest bits out a strip of rows at a time as NumPy arrays, searches each strip for the delimiters
+# all at once, and stops reading rows as soon as the message delimiter has been found.
+#
+# Version 2 framing:
+# Cipher text can contain the delimiter pattern, which cuts the message short.  So new images no longer use delimiters.
+# Instead the message bits start with a 12 byte header holding a magic string, the format version, the message length and the info length.
+# The header starts with a 0 byte, while a delimited message always starts with a 1 bit, so the decoder can tell the two formats apart
+# and only reads as many pixels as the header says carry bits.
+# encodeStream takes the message in chunks, such as the cipher text coming out of the AES encryption, and encodes each chunk as it arrives.
+# decodeStream does the reverse, handing the message back one strip of rows at a time so it can be decrypted while the rest is still being read.
+#
+# Version 3 framing:
+# Version 2 only puts one message bit into the blue color of each pixel, so a large message needs a huge cover image.
+# Version 3 puts k bits, k from 1 to 4, into the lowest bits of each of the red, green and blue colors, 3k message bits per pixel.
+# Its 13 byte header adds k after the format version and is still encoded one bit per pixel into the blue colors, so it is found the same way.
+# The info string stays in the green colors one bit per pixel, so the message starts on the first pixel after both the header and the info string.
+# The bits are grouped into color values and spread into the pixels, or pulled back out, with NumPy array operations.
+#
+# Version 4 framing:
+# A message too large for one cover can be split into shards, one per cover, each a version 4 frame.
+# Its 25 byte header adds a set id shared by every shard of the message, the shard's index and the number of shards in the set,
+# and is encoded one bit per pixel into the blue colors like the others.  The bits per color are 0 for a message in the blue colors only.
+# The message starts after the header, and after the info string too when it uses every color, the same way as versions 2 and 3.
+# decodeShard reads a version 4 frame, decodeStream turns them away as a shard alone is only part of a message.
+#
+# Capacity:
+# capacity works out how many message and info bytes an image can hold from its size and mode alone.
+# Opening an image only reads its header, so this costs next to nothing no matter how large the image is.
+# encodeStream refuses a message or info string that doesn't fit instead of cutting it short.
+#
+# Verification:
+# Before the cover image is saved encodeStream reads the header, message and info bits back out of the image it just wrote
+# and checks them against what it was handed, the message by a SHA-256 digest taken while the chunks came in.
+# This catches a message that didn't fit or bits that were overwritten, without saving, reopening and decoding the image.
+#
+# encodeStream times loading, embedding, verifying and saving the image with Instrument,
+# and counts the pixels touched and the bits embedded.
+#
+# Striping:
+# Large covers can be encoded and decoded by a pool of worker processes.  The pixels are copied into a shared array and the message
+# bytes into a second one, which the workers inherit when they are started, so no pixel data is ever pickled.
+# The message pixels are split into stripes of STRIPE_PIXELS pixels, a multiple of 8, so each stripe carries a whole number of
+# message bytes and knows which ones from its position alone.  Stripes are encoded as soon as their bytes have come in,
+# and decoded stripes are handed on in order as soon as they are done, so encryption and decryption still overlap the image work.
+# Each pixel is written by exactly one stripe, so the image comes out the same as with the serial engine.
+# The PNG itself is still decoded and saved by one process.
 
 # The structure of the LSB comes from a video tutorial done by DrapTV 
 # "Steganography Tutorial - Hiding Text inside an Image" By DrapTV
 # DrapTV. "Steganography Tutorial - Hiding Text inside an Image." YouTube, 22 Mar. 2014, https://www.youtube.com/watch?v=q3eOOMx5qoo&t=25s.
 
 
-
-import binascii
-import random
+import hashlib
+import multiprocessing
+import struct
 import sys
+import numpy
 from PIL import Image
 
+import preFileProcess as preFile
+import Instrument
 
-def rgb2bin(r, g, b):
-    """ Convert the pixel tuple (red, green, blue) into a bit pattern of the form 0brr...rgg..ggbb..bb 
-    
-    Steps:
-    1) Convert each color from in to binary.
-    2) Standardize the size of each bit pattern. 
-       Then return the each bit patter appended togeather.
-    """
 
-    # 1)
-    # ---------------------------------------------------------------------------------------------
-    red = bin(int(binascii.hexlify(str(r)), 16))
-    green = bin(int(binascii.hexlify(str(g)), 16))
-    blue = bin(int(binascii.hexlify(str(b)), 16))
+# Fifteen 1's and one 0 marking the end of the message and info bit patterns
+DELIMITER_BITS = numpy.array([1] * 15 + [0], dtype=numpy.uint8)
 
-    # 2)
-    # ---------------------------------------------------------------------------------------------
-    if len(red[2:]) < 24:
-        buff = "0" * (24 - len(red[2:]))
-        red = "0b" + buff + red[2:]
+# Number of pixels pulled out of the image at a time while decoding
+DECODE_CHUNK_PIXELS = 1 << 16
 
-    if len(green[2:]) < 24:
-        buff = "0" * (24 - len(green[2:]))
-        green = "0b" + buff + green[2:]
-    
-    if len(blue[2:]) < 24:
-        buff = "0" * (24 - len(blue[2:]))
-        blue = "0b" + buff + blue[2:]
+# Version 2 header: magic, format version, message length and info length
+FRAME_MAGIC = '\x00HE'
+FRAME_VERSION = 2
+FRAME_HEADER = struct.Struct('>3sBII')
 
-    return red + green[2:] + blue[2:]
+# Version 3 header: magic, format version, bits per color, message length and info length
+FRAME_VERSION_WIDE = 3
+FRAME_HEADER_WIDE = struct.Struct('>3sBBII')
+MAX_CHANNEL_BITS = 4
 
+# Version 4 header: magic, format version, bits per color (0 for blue only), set id, shard index, shard count,
+# message length and info length
+FRAME_VERSION_SHARD = 4
+FRAME_HEADER_SHARD = struct.Struct('>3sBB8sHHII')
+SHARD_ID_SIZE = 8
 
-def bin2rgb(binCode):
-    """ Convert the bit pattern of the from 0brr...rgg..ggbb..bb back into the pixel tuple (red, green, blue).
-    
-    Steps:
-    1) Grab the bit pattern for each color from the whole bit pattern.
-    2) Convert each color's bit pattern back to an interger.
-    """
+# Pixels in each stripe handed to a worker process, a multiple of 8 so every stripe starts on a whole byte of the message
+STRIPE_PIXELS = 1 << 20
 
-    # 1)
-    # ---------------------------------------------------------------------------------------------
-    red = binCode[2:26]
-    green = binCode[26:50]
-    blue = binCode[50:74]
+# Fewest message pixels worth spreading over worker processes
+STRIPE_MIN_PIXELS = 1 << 22
 
-    # 2)
-    # ---------------------------------------------------------------------------------------------
-    r = binascii.unhexlify("%x" % (int(red, 2)))
-    g = binascii.unhexlify("%x" % (int(green, 2)))
-    b = binascii.unhexlify("%x" % (int(blue, 2)))
+# The shared pixel and message arrays of the striped engine, as seen by a worker process
+sharedPixels = None
+sharedMessage = None
 
-    return int(r) , int(g) , int(b)
 
+def bits2str(bits):
+    """ Pack an array of bits back into ascii characters.
+        The bits are left padded with zeros to whole bytes, undoing the leading zeros the delimiter format drops from its first character."""
+    padding = (-len(bits)) % 8
+    if padding:
+        bits = numpy.concatenate((numpy.zeros(padding, dtype=numpy.uint8), bits))
+    return numpy.packbits(bits).tostring()
 
-def str2bin(message):
-    """ Convert the ascii characters into there bit patterns."""
-    binary = bin(int(binascii.hexlify(message), 16))
-    return binary[2:]
 
+def findDelimiter(bits):
+    """ Return the index of the last bit of the first delimiter found in the bit array, or -1 if there is none.
 
-def binary2str(binary):
-    """ Convert the bit pattern into ascii characters"""
-    message = binascii.unhexlify('%x' % (int('0b' + binary, 2)))
-    return message
+    A running count of the 1 bits gives the number of 1's in every 15 bit window at once,
+    so a delimiter ends at every 0 bit whose previous 15 bits add up to 15.
+    """
+    if len(bits) < len(DELIMITER_BITS):
+        return -1
+
+    ones = numpy.concatenate(([0], numpy.cumsum(bits, dtype=numpy.int64)))
+    ends = numpy.flatnonzero(bits[15:] == 0) + 15
+    hits = ends[ones[ends] - ones[ends - 15] == 15]
+    if len(hits) == 0:
+        return -1
+    return int(hits[0])
+
+
+def bytes2bits(message):
+    """ Convert the ascii characters into an array of bits, keeping every leading zero bit."""
+    return numpy.unpackbits(numpy.frombuffer(message, dtype=numpy.uint8))
+
+
+def packHeader(messageLength, infoLength, channelBits=None, shard=None):
+    """ Build the header for a message and info string of the given lengths.
+        Without channelBits this is a version 2 header, otherwise a version 3 header with channelBits bits per color.
+        When shard, the (set id, index, count) of a shard, is given this is a version 4 header."""
+    if shard != None:
+        setId, index, count = shard
+        return FRAME_HEADER_SHARD.pack(FRAME_MAGIC, FRAME_VERSION_SHARD, channelBits or 0, setId, index, count, messageLength, infoLength)
+    if channelBits == None:
+        return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, messageLength, infoLength)
+    return FRAME_HEADER_WIDE.pack(FRAME_MAGIC, FRAME_VERSION_WIDE, channelBits, messageLength, infoLength)
+
+
+def unpackHeader(header):
+    """ Return the message length, info length and bits per color stored in a version 2 or 3 header, or None when the bytes are neither.
+        The bits per color are None for a version 2 header."""
+    if len(header) < FRAME_HEADER.size:
+        return None
+    magic, version, messageLength, infoLength = FRAME_HEADER.unpack(header[:FRAME_HEADER.size])
+    if magic != FRAME_MAGIC:
+        return None
+    if version == FRAME_VERSION:
+        return messageLength, infoLength, None
 
+    if version == FRAME_VERSION_WIDE and len(header) >= FRAME_HEADER_WIDE.size:
+        magic, version, channelBits, messageLength, infoLength = FRAME_HEADER_WIDE.unpack(header[:FRAME_HEADER_WIDE.size])
+        if 1 <= channelBits <= MAX_CHANNEL_BITS:
+            return messageLength, infoLength, channelBits
+    return None
 
-def encodeOneBit(bincode, messageBit):
-    """ When the bit pattern for the blue channel end with 0 or 1 
-        replace it with the current bit from the message"""
-    if bincode[-1] in ('0', '1'):
-        bincode = bincode[:-1] + messageBit
-        return bincode
-    else:
-        return None
 
-def decodeOneBit(bincode):
-    """ When the blue channel's bit pattern end with a 0 or 1
-        grab the bit as it's part of the message"""
-    if bincode[-1] in ('0', '1'):
-        return bincode[-1]
-    else:
+def unpackShardHeader(header):
+    """ Return the (set id, index, count), message length, info length and bits per color stored in a version 4 header,
+        or None when the bytes aren't one.  The bits per color are None for a message in the blue colors only."""
+    if len(header) < FRAME_HEADER_SHARD.size:
+        return None
+    magic, version, channelBits, setId, index, count, messageLength, infoLength = FRAME_HEADER_SHARD.unpack(header[:FRAME_HEADER_SHARD.size])
+    if magic != FRAME_MAGIC or version != FRAME_VERSION_SHARD or channelBits > MAX_CHANNEL_BITS or index >= count:
         return None
+    return (setId, index, count), messageLength, infoLength, channelBits or None
 
-def encodeTwoBits(bincode, messageBit, infoBit):
-    """ When the bit pattern for the blue and green channel end with 0 or 1:
-        Replace the blue channel's bit with the current bit from the message.
-        Replace the green channel's bit with the current bit from the AES infomation string."""
 
-    if bincode[-1] in ('0', '1') and bincode[-23] in ('0', '1'):
-        bincode = bincode[:-1] + messageBit
-        bincode = bincode[:-25] + infoBit + bincode[-24:]
+def messageStart(infoLength, channelBits, shard=False):
+    """ Pixel the message starts on.  Version 2 messages follow the header in the blue colors,
+        version 3 messages use every color so they start after both the header and the info string.
+        shard is True, or the (set id, index, count) of a shard, for version 4, which has a longer header."""
+    if shard:
+        if channelBits == None:
+            return FRAME_HEADER_SHARD.size * 8
+        return max(FRAME_HEADER_SHARD.size * 8, infoLength * 8)
+    if channelBits == None:
+        return FRAME_HEADER.size * 8
+    return max(FRAME_HEADER_WIDE.size * 8, infoLength * 8)
 
-        return bincode
-    else:
-        return None
 
-def decodeTwoBits(bincode):
-    """ When the blue and green channeles bit pattern end with a 0 or 1:
-        Grab the blue channel bit as it's part of the message.
-        Grab the green channel bit as it's part of the AES infomation string."""
-    if bincode[-1] in ('0', '1'):
-        return bincode[-1], bincode[-25]
-    else:
-        return None, None
+def messagePixels(messageLength, channelBits):
+    """ Number of pixels carrying a message of messageLength bytes """
+    if channelBits == None:
+        return messageLength * 8
+    return (messageLength * 8 + 3 * channelBits - 1) // (3 * channelBits)
+
+
+def frameCapacity(pixels, infoLength, channelBits, shard=False):
+    """ Return the number of message bytes and info bytes that fit into an image of the given number of pixels,
+        when the info string is infoLength bytes long."""
+    messageBits = max(0, pixels - messageStart(infoLength, channelBits, shard))
+    if channelBits != None:
+        messageBits *= 3 * channelBits
+    return messageBits // 8, pixels // 8
+
+
+def capacity(filename, channelBits=None, infoLength=0, shard=False):
+    """ Return the number of message bytes and info bytes the given image can hold, reading only the image's header.
+        Images that aren't RGB or RGBA can't hold anything.  shard is True for the room left by a version 4 header."""
+    img = Image.open(filename)
+    if img.mode not in ('RGBA'):
+        return 0, 0
+    width, height = img.size
+    return frameCapacity(width * height, infoLength, channelBits, shard)
+
+
+def channelMask(channelBits):
+    """ Mask keeping the color bits that don't carry message bits """
+    return 0xFF ^ ((1 << channelBits) - 1)
+
+
+def bits2values(bits, channelBits):
+    """ Group an array of bits into (pixels, 3) red, green and blue values of channelBits bits each, highest bit first.
+        The last pixel is padded with zero bits."""
+    padding = (-len(bits)) % (3 * channelBits)
+    if padding:
+        bits = numpy.concatenate((bits, numpy.zeros(padding, dtype=numpy.uint8)))
+    shifts = numpy.arange(channelBits - 1, -1, -1, dtype=numpy.uint8)
+    return (bits.reshape(-1, 3, channelBits) << shifts).sum(axis=2, dtype=numpy.uint8)
+
+
+def values2bits(values, channelBits):
+    """ Split (pixels, 3) red, green and blue values back into an array of channelBits bits each, highest bit first."""
+    shifts = numpy.arange(channelBits - 1, -1, -1, dtype=numpy.uint8)
+    return ((values[:, :, numpy.newaxis] >> shifts) & 1).reshape(-1)
+
+
+def writeBits(pixels, channel, start, bits, mask=0xFE):
+    """ Encode the bits into the lowest bit of one channel of a flattened (pixels, 4) RGBA array in place, starting at pixel start.
+        With channel slice(0, 3) and a mask from channelMask, bits holds the (pixels, 3) values from bits2values instead.
+
+    Every pixel carrying a bit has its alpha set to 255.  Bits past the end of the image are dropped.
+    Returns the number of pixels written that fit into the image.
+    """
+    end = min(start + len(bits), len(pixels))
+    if end <= start:
+        return 0
+
+    pixels[start:end, channel] = (pixels[start:end, channel] & mask) | bits[:end - start]
+    pixels[start:end, 3] = 255
+
+    return end - start
+
+
+def writeImageBits(img, channel, start, bits, mask=0xFE):
+    """ Encode the bits into the lowest bit of one channel of an RGBA image in place, starting at pixel start, the same way as writeBits.
+
+    Only the rows carrying bits are copied out of the image, a strip of rows at a time, and pasted back once changed.
+    Returns the number of bits that fit into the image.
+    """
+    width, height = img.size
+    end = min(start + len(bits), width * height)
+    rowsPerChunk = max(1, DECODE_CHUNK_PIXELS // width)
+
+    written = 0
+    for top in range(start // width, (end + width - 1) // width, rowsPerChunk):
+        strip = numpy.array(img.crop((0, top, width, min(top + rowsPerChunk, height))))
+        first = max(start - top * width, 0)
+        written += writeBits(strip.reshape(-1, 4), channel, first, bits[top * width + first - start:], mask)
+        img.paste(Image.fromarray(strip, 'RGBA'), (0, top))
+
+    return written
+
+
+def verifyFrame(img, messageLength, messageDigest, infoMessage, channelBits=None, shard=None):
+    """ Check that an RGBA image holds the header, a message with the given SHA-256 digest and the info string.
+        The message bits are read back a strip of rows at a time."""
+    width, height = img.size
+    headerBits = bytes2bits(packHeader(messageLength, len(infoMessage), channelBits, shard))
+    infoBits = bytes2bits(infoMessage)
+    start = messageStart(len(infoMessage), channelBits, shard)
+    messageRoom, infoRoom = frameCapacity(width * height, len(infoMessage), channelBits, shard)
+    if messageRoom < messageLength or infoRoom < len(infoMessage):
+        return False
+
+    binaryMessage, binaryInfo = readBits(img, max(len(headerBits), len(infoBits)))
+    if not numpy.array_equal(binaryMessage[:len(headerBits)], headerBits):
+        return False
+    if not numpy.array_equal(binaryInfo[:len(infoBits)], infoBits):
+        return False
+
+    digest = hashlib.sha256()
+    for chunk in readMessage(img, start, messageLength, channelBits):
+        digest.update(chunk)
+    return digest.digest() == messageDigest
+
+
+def readBits(img, count):
+    """ Pull the message bits and info bits out of the first count pixels of the image, a strip of rows at a time."""
+    width, height = img.size
+    rows = min(height, (count + width - 1) // width)
+    rowsPerChunk = max(1, DECODE_CHUNK_PIXELS // width)
+
+    messageChunks = []
+    infoChunks = []
+    for top in range(0, rows, rowsPerChunk):
+        strip = numpy.asarray(img.crop((0, top, width, min(top + rowsPerChunk, rows)))).reshape(-1, 4)
+        messageChunks.append(strip[:, 2] & 1)
+        infoChunks.append(strip[:, 1] & 1)
+
+    if not messageChunks:
+        return numpy.zeros(0, dtype=numpy.uint8), numpy.zeros(0, dtype=numpy.uint8)
+    return numpy.concatenate(messageChunks)[:count], numpy.concatenate(infoChunks)[:count]
 
 
 def encode(filename, cipherMessage, infoMessage):
-    """ Encode the given message into the given image
+    """ Encode the given message into the given image """
+    return encodeStream(filename, [cipherMessage], len(cipherMessage), infoMessage)
+
+
+def encodeStream(filename, cipherChunks, messageLength, infoMessage, verify=True, channelBits=None, outName=None, workers=1,
+                 shard=None):
+    """ Encode a message handed over in chunks into the given image, without ever holding the whole message
+        Without channelBits the message goes into the blue colors in the version 2 format,
+        otherwise channelBits bits go into each of the red, green and blue colors in the version 3 format.
+        The cover image is saved as outName, or next to the image with _encode added to its name.
+        With more than one worker, a message covering at least STRIPE_MIN_PIXELS pixels is encoded in stripes by worker processes,
+        which gives the same image.
+        When shard, the (set id, index, count) of a shard, is given the message is encoded as that shard in the version 4 format.
     
     Steps:
-    1) Convert the given message and information string into binary and add on the delemiter 15 1's with one zero to each
-       Then check if the provided image is the correct image format 
-    2) Reading in one pixel at a time from the image:
-        - Determine with there is still message bits and infomation bits, 
-          calling the correct encoding step or no coding step depending on.
-        - If a bit was encoded, convert the pixel it back into is color numbers and append it to the image out list
-          Otherwise just append the unmodified pixel to the image out list
-    3) Create the cover image.
+    1) Check if the provided image is the correct image format and large enough.
+    2) Load the image and encode the header, the information string and the message into it, a strip of rows at a time
+       or in stripes by worker processes.
+    3) When verify is set, check the image holds the header, message and information string.
+    4) Create the cover image, it only shows up under its name once it has been completely written.
     """
     
     # 1)
     # ---------------------------------------------------------------------------------------------
-    binaryMessage = str2bin(cipherMessage) + '1111111111111110'
-    binaryInfo = str2bin(infoMessage) + '1111111111111110'
+    if channelBits != None and not 1 <= channelBits <= MAX_CHANNEL_BITS:
+        raise ValueError("Bits per color must be between 1 and %d" % MAX_CHANNEL_BITS)
+
     img = Image.open(filename)
     if img.mode in ('RGBA'):
-        img = img.convert('RGBA')
-        data = img.getdata()
-
-        newData = []
-        digit = 0
-        temp = ''
+        width, height = img.size
+        messageRoom, infoRoom = frameCapacity(width * height, len(infoMessage), channelBits, shard)
+        if messageRoom < messageLength or infoRoom < len(infoMessage):
+            return "Image too small"
 
         # 2)
         # ---------------------------------------------------------------------------------------------
-        for item in data:
-            if (digit < len(binaryMessage)):
-                
-                if (digit < len(binaryInfo)):
-                    newpix = encodeTwoBits(rgb2bin(item[0], item[1], item[2]), binaryMessage[digit], binaryInfo[digit])
-                else:
-                    # Convert out pixel into a binary code and give which ever bit of the message we are currently on, a 0 or a 1
-                    newpix = encodeOneBit(rgb2bin(item[0], item[1], item[2]), binaryMessage[digit])
-            
-                if newpix == None:
-                    newData.append(item)
-                else:
-                    
-                    r, g, b = bin2rgb(newpix)
-                    
-                    newData.append((r,g,b,255))
-                    digit += 1
-            else:
-                newData.append(item)
-        
-        # 3) 
+        if workers > 1 and messagePixels(messageLength, channelBits) >= STRIPE_MIN_PIXELS:
+            img, digest = embedStriped(filename, cipherChunks, messageLength, infoMessage, channelBits, workers, shard)
+        else:
+            img, digest = embedSerial(img, cipherChunks, messageLength, infoMessage, channelBits, shard)
+
+        headerLength = len(packHeader(messageLength, len(infoMessage), channelBits, shard))
+        Instrument.count("pixelsTouched", max(messageStart(len(infoMessage), channelBits, shard) + messagePixels(messageLength, channelBits),
+                                              headerLength * 8, len(infoMessage) * 8))
+        Instrument.count("bitsEmbedded", (headerLength + len(infoMessage) + messageLength) * 8)
+
+        # 3)
         # ---------------------------------------------------------------------------------------------
-        img.putdata(newData)
-        img.save(filename[:-4] + "_encode" + filename[-4:], "PNG")
+        with Instrument.span("verify"):
+            if verify and not verifyFrame(img, messageLength, digest, infoMessage, channelBits, shard):
+                return "Verification failed"
+
+        # 4) 
+        # ---------------------------------------------------------------------------------------------
+        if outName == None:
+            outName = filename[:-4] + "_encode" + filename[-4:]
+        with Instrument.span("save"):
+            with preFile.atomicWrite(outName) as imageOut:
+                img.save(imageOut, "PNG")
         
         return "Completed!"
     return "Incorrect image mode"
 
-def decode(filename):
-    """ Pull the message out of the given image
+
+def embedSerial(img, cipherChunks, messageLength, infoMessage, channelBits, shard=None):
+    """ Load the image and encode the header, information string and message chunks into it in place, a strip of rows at a time.
+        Bits that don't fill a whole pixel are held back for the next chunk, the last pixel is padded with zero bits.
+        The chunks must add up to messageLength, the length written into the header.
+        Returns the image and the SHA-256 digest of the message."""
+
+    with Instrument.span("load", pixels=img.size[0] * img.size[1]):
+        # Converting an image that already is RGBA would only make a second copy of it
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
+        img.load()
+
+    with Instrument.span("embed"):
+        writeImageBits(img, 2, 0, bytes2bits(packHeader(messageLength, len(infoMessage), channelBits, shard)))
+        writeImageBits(img, 1, 0, bytes2bits(infoMessage))
+
+        if channelBits == None:
+            channel, mask, pixelBits = 2, 0xFE, 1
+        else:
+            channel, mask, pixelBits = slice(0, 3), channelMask(channelBits), 3 * channelBits
+
+        position = messageStart(len(infoMessage), channelBits, shard)
+        pending = numpy.zeros(0, dtype=numpy.uint8)
+        written = 0
+        digest = hashlib.sha256()
+        for chunk in cipherChunks:
+            bits = numpy.concatenate((pending, bytes2bits(chunk)))
+            whole = len(bits) - len(bits) % pixelBits
+            pending = bits[whole:]
+            values = bits[:whole] if channelBits == None else bits2values(bits[:whole], channelBits)
+            writeImageBits(img, channel, position, values, mask)
+            position += len(values)
+            written += len(chunk)
+            digest.update(chunk)
+
+        if len(pending):
+            writeImageBits(img, channel, position, bits2values(pending, channelBits), mask)
+
+        if written != messageLength:
+            raise ValueError("Message was %d bytes long instead of %d" % (written, messageLength))
+
+    return img, digest.digest()
+
+
+def shareImage(filename):
+    """ Decode the image file into a shared array, as RGBA.
+        An RGBA image is decoded straight into the shared array, so its pixels are only ever held once,
+        any other image is decoded by PIL and converted into the shared array a strip of rows at a time.
+        Returns the shared array, a (pixels, 4) NumPy view of it, the image size and the image's info dictionary."""
+    img = Image.open(filename)
+    width, height = img.size
+    shared = multiprocessing.RawArray('B', width * height * 4)
+    pixels = numpy.frombuffer(shared, dtype=numpy.uint8).reshape(-1, 4)
+
+    if img.mode == 'RGBA':
+        # PIL decodes into the image memory it already has when the mode and size match, here the shared array
+        img.im = Image.frombuffer('RGBA', img.size, shared, 'raw', 'RGBA', 0, 1).im
+        img.load()
+    else:
+        rowsPerChunk = max(1, DECODE_CHUNK_PIXELS // width)
+        for top in range(0, height, rowsPerChunk):
+            bottom = min(top + rowsPerChunk, height)
+            pixels[top * width:bottom * width] = numpy.asarray(img.crop((0, top, width, bottom)).convert('RGBA')).reshape(-1, 4)
+    return shared, pixels, img.size, img.info
+
+
+def attachShared(pixels, message):
+    """ Pool initializer giving a worker process NumPy views of the shared pixel and message arrays it inherited """
+    global sharedPixels, sharedMessage
+    sharedPixels = numpy.frombuffer(pixels, dtype=numpy.uint8).reshape(-1, 4)
+    sharedMessage = numpy.frombuffer(message, dtype=numpy.uint8)
+
+
+def stripeJobs(start, messageLength, channelBits):
+    """ Split the pixels carrying a message, starting at pixel start, into stripes of STRIPE_PIXELS pixels.
+        Returns (first pixel, end pixel, first byte, end byte, channelBits) for each stripe, with the message bytes the stripe carries."""
+    pixelBits = 1 if channelBits == None else 3 * channelBits
+    end = start + messagePixels(messageLength, channelBits)
+    jobs = []
+    for first in range(start, end, STRIPE_PIXELS):
+        last = min(first + STRIPE_PIXELS, end)
+        jobs.append((first, last, (first - start) * pixelBits // 8, min((last - start) * pixelBits // 8, messageLength), channelBits))
+    return jobs
+
+
+def embedStripe(job):
+    """ Encode one stripe of the shared message into the shared pixels, in a worker process """
+    first, last, byteStart, byteEnd, channelBits = job
+    bits = numpy.unpackbits(sharedMessage[byteStart:byteEnd])
+    if channelBits == None:
+        writeBits(sharedPixels, 2, first, bits)
+    else:
+        writeBits(sharedPixels, slice(0, 3), first, bits2values(bits, channelBits), channelMask(channelBits))
+    return first
+
+
+def extractStripe(job):
+    """ Decode one stripe of the shared pixels into the shared message, in a worker process """
+    first, last, byteStart, byteEnd, channelBits = job
+    if channelBits == None:
+        bits = sharedPixels[first:last, 2] & 1
+    else:
+        bits = values2bits(sharedPixels[first:last, :3] & ((1 << channelBits) - 1), channelBits)
+    sharedMessage[byteStart:byteEnd] = numpy.packbits(bits[:(byteEnd - byteStart) * 8])
+    return byteStart, byteEnd
+
+
+def embedStriped(filename, cipherChunks, messageLength, infoMessage, channelBits, workers, shard=None):
+    """ Encode the header, information string and message chunks into the image the same way embedSerial does,
+        with the pixels and the message in shared memory and the message encoded in stripes by workers worker processes.
+        A stripe is handed to the workers as soon as the chunks carrying its bytes have come in.
+        Returns the encoded image, backed by the shared pixels, and the SHA-256 digest of the message."""
+
+    with Instrument.span("load", workers=workers):
+        shared, pixels, size, info = shareImage(filename)
+    message = multiprocessing.RawArray('B', max(1, messageLength))
+    messageView = numpy.frombuffer(message, dtype=numpy.uint8)
+
+    with Instrument.span("embed", workers=workers):
+        # The header and the information string are short, so they are encoded before any worker starts
+        writeBits(pixels, 2, 0, bytes2bits(packHeader(messageLength, len(infoMessage), channelBits, shard)))
+        writeBits(pixels, 1, 0, bytes2bits(infoMessage))
+
+        jobs = stripeJobs(messageStart(len(infoMessage), channelBits, shard), messageLength, channelBits)
+        pool = multiprocessing.Pool(workers, attachShared, (shared, message))
+        try:
+            running = []
+            written = 0
+            digest = hashlib.sha256()
+            for chunk in cipherChunks:
+                if written + len(chunk) > messageLength:
+                    raise ValueError("Message is longer than %d bytes" % messageLength)
+                messageView[written:written + len(chunk)] = numpy.frombuffer(chunk, dtype=numpy.uint8)
+                written += len(chunk)
+                digest.update(chunk)
+                while len(running) < len(jobs) and jobs[len(running)][3] <= written:
+                    running.append(pool.apply_async(embedStripe, (jobs[len(running)],)))
+
+            if written != messageLength:
+                raise ValueError("Message was %d bytes long instead of %d" % (written, messageLength))
+            for result in running:
+                result.get()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    img = Image.frombuffer('RGBA', size, shared, 'raw', 'RGBA', 0, 1)
+    # PIL takes an image on a buffer for read only and copies it whole before saving it, the shared array can be written to
+    img.readonly = 0
+    img.info = info
+    return img, digest.digest()
+
+
+def decodeLegacy(img):
+    """ Pull the message out of an image encoded with the delimiter format
     
     Steps:
-    1) Stetup the output strings and check if the provided image is the correct image format 
-    2) Reading in one pixel at a time from the image:
-        - Get the message and infomation bit from the pixel.
-        - Check if the delimiter has been hit for both the message and information string.
+    1) Setup the bit arrays.
+    2) Reading in one strip of rows at a time from the image:
+        - Get the message bits and infomation bits from the strip.
+        - Search the strip for the delimiter of the information string until it has been found.
+        - Search the strip for the delimiter of the message, stop reading strips once it has been found.
     3) Convert both the message bit pattern and infomation string bit pattern into strings and return them back the the caller.
     """
 
+    # 1)
+    # ---------------------------------------------------------------------------------------------
+    width, height = img.size
+    rowsPerChunk = max(1, DECODE_CHUNK_PIXELS // width)
+
+    messageChunks = []
+    infoChunks = []
+    messageTail = numpy.zeros(0, dtype=numpy.uint8)
+    infoTail = numpy.zeros(0, dtype=numpy.uint8)
+    messageEnd = -1
+    infoEnd = -1
+    bitsRead = 0
+
+    # 2)
+    # ---------------------------------------------------------------------------------------------
+    for top in range(0, height, rowsPerChunk):
+        strip = numpy.asarray(img.crop((0, top, width, min(top + rowsPerChunk, height)))).reshape(-1, 4)
+
+        # Search the new bits along with the last 15 bits already read, in case a delimiter crosses two strips
+        if infoEnd == -1:
+            infoChunks.append(strip[:, 1] & 1)
+            window = numpy.concatenate((infoTail, infoChunks[-1]))
+            found = findDelimiter(window)
+            if found != -1:
+                infoEnd = bitsRead - len(infoTail) + found
+            infoTail = window[-15:]
+
+        messageChunks.append(strip[:, 2] & 1)
+        window = numpy.concatenate((messageTail, messageChunks[-1]))
+        found = findDelimiter(window)
+        if found != -1:
+            messageEnd = bitsRead - len(messageTail) + found
+            break
+        messageTail = window[-15:]
+        bitsRead += len(strip)
+
+    # 3)
+    # ---------------------------------------------------------------------------------------------
+    binaryMessage = numpy.concatenate(messageChunks)
+    binaryInfo = numpy.concatenate(infoChunks)
+
+    # The info bit sharing a pixel with the end of the message delimiter is never part of the information string
+    if messageEnd != -1:
+        binaryMessage = binaryMessage[:messageEnd - 15]
+        binaryInfo = binaryInfo[:messageEnd]
+    if infoEnd != -1 and infoEnd < len(binaryInfo):
+        binaryInfo = binaryInfo[:infoEnd + 1]
+
+    return bits2str(binaryMessage), bits2str(binaryInfo[:-16])
+
+
+def decode(filename):
+    """ Pull the message out of the given image """
+    messageBack = decodeStream(filename)
+    if messageBack == "Incorrect Image mode":
+        return messageBack
+
+    info, messageChunks = messageBack
+    return ''.join(messageChunks), info
+
+
+def decodeStream(filename, workers=1):
+    """ Pull the information string out of the given image, and set up the message to be pulled out a strip of rows at a time
+        With more than one worker, a message covering at least STRIPE_MIN_PIXELS pixels is pulled out in stripes by worker processes.
+    
+    Steps:
+    1) Check if the provided image is the correct image format 
+    2) Read the header from the first pixels, images without a version 2 or 3 header are decoded with the delimiter format.
+    3) Read the information string, and hand it back with a generator that reads the message out of the pixels carrying it.
+    """
+
     # 1)
     # ---------------------------------------------------------------------------------------------
     img = Image.open(filename)
-    binaryMessage = ''
-    binaryInfo = ''
-    infoDone = 'f'
 
     if img.mode in ('RGBA'):
-        img = img.convert('RGBA')
-        data = img.getdata()
+        # Converting an image that already is RGBA would only make a second copy of it
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
 
         # 2)
         # ---------------------------------------------------------------------------------------------
-        for item in data:
-    
-            if infoDone != 't':
-                messageBit, infoBit = decodeTwoBits(rgb2bin(item[0], item[1], item[2]))
-            else:
-                messageBit = decodeOneBit(rgb2bin(item[0], item[1], item[2]))
-            
-            if messageBit == None:
-                pass
-            else:
-                binaryMessage = binaryMessage + messageBit
-                if (binaryMessage[-16:] == '1111111111111110'):
-                    return binary2str(binaryMessage[:-16]), binary2str(binaryInfo[:-16])
-                
-                if infoDone != 't':
-                    binaryInfo = binaryInfo + infoBit
-
-                    if (binaryInfo[-16:] == '1111111111111110'):
-                        infoDone = 't'
+        binaryMessage, binaryInfo = readBits(img, FRAME_HEADER_SHARD.size * 8)
+        header = bits2str(binaryMessage[:len(binaryMessage) - len(binaryMessage) % 8])
+        if unpackShardHeader(header) != None:
+            raise ValueError("Image holds one shard of a message, decode it with decodeShard")
+        lengths = unpackHeader(header)
+        if lengths == None:
+            message, info = decodeLegacy(img)
+            return info, iter([message])
+        messageLength, infoLength, channelBits = lengths
 
         # 3)
         # ---------------------------------------------------------------------------------------------
-        return binary2str(binaryMessage), binary2str(binaryInfo[:-16])
+        binaryMessage, binaryInfo = readBits(img, infoLength * 8)
+        info = bits2str(binaryInfo)
+        return info, messageChunks(img, filename, messageStart(infoLength, channelBits), messageLength, channelBits, workers)
     return "Incorrect Image mode"
+
+
+def decodeShard(filename, workers=1):
+    """ Pull the shard header and information string out of an image holding one shard of a message,
+        and set up the shard's part of the message to be pulled out the same way as decodeStream.
+        Returns the (set id, index, count) of the shard, the information string and a generator of the message chunks.
+        Raises ValueError when the image doesn't hold a shard."""
+
+    img = Image.open(filename)
+    if img.mode not in ('RGBA'):
+        raise ValueError("Incorrect Image mode")
+    if img.mode != 'RGBA':
+        img = img.convert('RGBA')
+
+    binaryMessage, binaryInfo = readBits(img, FRAME_HEADER_SHARD.size * 8)
+    header = unpackShardHeader(bits2str(binaryMessage[:len(binaryMessage) - len(binaryMessage) % 8]))
+    if header == None:
+        raise ValueError("Image does not hold a shard")
+    shard, messageLength, infoLength, channelBits = header
+
+    binaryMessage, binaryInfo = readBits(img, infoLength * 8)
+    start = messageStart(infoLength, channelBits, shard)
+    return shard, bits2str(binaryInfo), messageChunks(img, filename, start, messageLength, channelBits, workers)
+
+
+def messageChunks(img, filename, start, messageLength, channelBits, workers):
+    """ Generator of the message chunks, read by workers processes in stripes when there are more than one
+        and the message covers at least STRIPE_MIN_PIXELS pixels, otherwise a strip of rows at a time.
+        The stripes are read from the image file decoded again into shared memory, so img can be let go before they are."""
+    if workers > 1 and messagePixels(messageLength, channelBits) >= STRIPE_MIN_PIXELS:
+        return readStriped(filename, start, messageLength, channelBits, workers)
+    return readMessage(img, start, messageLength, channelBits)
+
+
+def readMessage(img, start, messageLength, channelBits=None):
+    """ Read messageLength bytes of message bits, starting at pixel start, a strip of rows at a time.
+        Without channelBits the bits come from the blue colors, otherwise channelBits bits come from each of the red, green and blue colors.
+        Each strip's bytes are handed to the caller before the next strip is read."""
+
+    width, height = img.size
+    end = start + messagePixels(messageLength, channelBits)
+    remaining = messageLength
+    rowsPerChunk = max(1, DECODE_CHUNK_PIXELS // width)
+    leftover = numpy.zeros(0, dtype=numpy.uint8)
+
+    for top in range(start // width, (end + width - 1) // width, rowsPerChunk):
+        bottom = min(top + rowsPerChunk, height)
+        if top >= bottom:
+            break
+        strip = numpy.asarray(img.crop((0, top, width, bottom))).reshape(-1, 4)
+
+        # Keep only the pixels of the strip carrying the message
+        first = max(start - top * width, 0)
+        last = min(end - top * width, len(strip))
+        if channelBits == None:
+            bits = numpy.concatenate((leftover, strip[first:last, 2] & 1))
+        else:
+            bits = numpy.concatenate((leftover, values2bits(strip[first:last, :3] & ((1 << channelBits) - 1), channelBits)))
+
+        # The zero bits padding the last pixel are not part of the message
+        whole = min(len(bits) - len(bits) % 8, remaining * 8)
+        leftover = bits[whole:]
+        remaining -= whole // 8
+        if whole:
+            yield numpy.packbits(bits[:whole]).tostring()
+
+
+def readStriped(filename, start, messageLength, channelBits, workers):
+    """ Read messageLength bytes of message bits, starting at pixel start, out of the image file the same way as readMessage,
+        with the pixels and the message in shared memory and the stripes decoded by workers worker processes.
+        Each stripe's bytes are handed to the caller, in order, as soon as the stripe and the ones before it are decoded."""
+
+    shared, pixels, size, info = shareImage(filename)
+    message = multiprocessing.RawArray('B', max(1, messageLength))
+    messageView = numpy.frombuffer(message, dtype=numpy.uint8)
+
+    pool = multiprocessing.Pool(workers, attachShared, (shared, message))
+    try:
+        for byteStart, byteEnd in pool.imap(extractStripe, stripeJobs(start, messageLength, channelBits)):
+            yield messageView[byteStart:byteEnd].tostring()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,234 @@
+# Description
+# Run the text into image and image into text routines from RunProtocol without any prompts or file windows, over many files at once.
+#
+# Jobs come from a manifest or from directories:
+#   A CSV manifest has a header row naming its columns, a JSON manifest is a list of objects with the same names.
+#   Insert jobs need "text" and "cover" columns and may give an "output" image name,
+#   extract jobs need an "image" column and may give an "output" text file name.
+#   With --texts and --covers every text file is paired with the cover image of the same name, a.txt with a.png.
+#   With --images every image in the directory is extracted into --out, a_encode.png into a.txt.
+#   A manifest row that isn't an object or is missing one of the columns its routine needs finishes with status "manifest".
+#
+# The pin is read from the environment variable named by --pin-env, HIDDEN_PIN by default, or from the first line of the file
+# descriptor given by --pin-fd, so it never shows up in the command line or the manifest.
+#
+# The jobs are spread over a pool of worker processes.  One line is printed per job, as jobs finish, with the job's status code,
+# the same codes the interactive routines give, then a summary with the number of jobs per status code and the throughput.
+# A job that fails in a way the routines don't report finishes with status "error", the other jobs carry on.
+# The exit code is 0 when every job finished with Done, 1 otherwise and 2 when the jobs could not be started.
+#
+# Run with: python RunBatch.py insert (--manifest FILE | --texts DIR --covers DIR) [options]
+#           python RunBatch.py extract (--manifest FILE | --images DIR) [--out DIR] [options]
+
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import KeyModifer as keyMod
+import RunProtocol as protocol
+import preFileProcess as preFile
+import pycroptoEcrDecr as AES
+
+
+# Columns every manifest row needs, by routine
+REQUIRED_COLUMNS = {"insert": ("text", "cover"), "extract": ("image",)}
+
+
+class ExtractFailed(Exception):
+    """ Raised inside the atomicWrite block of an extract that failed, carrying the status code, so the text file is never written """
+
+
+def readPin(pinEnv, pinFd):
+    """ Read the pin from the file descriptor when one is given, otherwise from the environment variable.
+        Returns the pin as a list of character codes, or None when there is no usable pin."""
+
+    if pinFd != None:
+        with os.fdopen(pinFd, "r") as pinFile:
+            pin = pinFile.readline().rstrip("\r\n")
+    else:
+        pin = os.environ.get(pinEnv, "")
+
+    return checkPin(pin)
+
+
+def checkPin(pin):
+    """ Turn a 16 character pin into a list of character codes, or None when it isn't 16 characters long or can't mask a key """
+    if len(pin) != 16:
+        return None
+    pin = [ord(pin[i]) for i in range(16)]
+    if keyMod.invertable(pin):
+        return None
+    return pin
+
+
+def readManifest(fileName, columns):
+    """ Read the jobs out of a CSV or JSON manifest, each job is a dictionary of column name to value.
+        A row that isn't a dictionary or has no file name in one of the columns is turned into a job with status "manifest"
+        and its row number, so it is reported along with the other jobs instead of failing in a worker."""
+    with open(fileName, "rb") as manifest:
+        if fileName.lower().endswith(".json"):
+            rows = json.load(manifest)
+        else:
+            rows = list(csv.DictReader(manifest))
+
+    jobs = []
+    for number, row in enumerate(rows, 1):
+        if isinstance(row, dict) and all(isinstance(row.get(column), basestring) and row[column] for column in columns):
+            jobs.append(row)
+        else:
+            jobs.append({"status": "manifest", "row": number})
+    return jobs
+
+
+def pairDirectories(textDir, coverDir):
+    """ Pair every text file with the .png cover image of the same name, a text file without a cover gets a missing cover name """
+    jobs = []
+    for name in sorted(os.listdir(textDir)):
+        if os.path.isfile(os.path.join(textDir, name)):
+            jobs.append({"text": os.path.join(textDir, name),
+                         "cover": os.path.join(coverDir, os.path.splitext(name)[0] + ".png")})
+    return jobs
+
+
+def listImages(imageDir, outDir):
+    """ Make an extract job for every _encode.png image in the directory, writing the text into outDir """
+    jobs = []
+    for name in sorted(os.listdir(imageDir)):
+        if name.endswith("_encode.png"):
+            jobs.append({"image": os.path.join(imageDir, name),
+                         "output": os.path.join(outDir, name[:-len("_encode.png")] + ".txt")})
+    return jobs
+
+
+def runInsert(job):
+    """ Run one insert job in a worker process, returns the job, its status code, the text file size and the seconds it took """
+    start = time.time()
+    if job.get("status"):
+        return job, job["status"], 0, 0.0
+
+    options = job["options"]
+    try:
+        size = os.path.getsize(job["text"])
+    except OSError:
+        return job, "text", 0, time.time() - start
+
+    # The jobs are already spread over the cores, so the AES of each job runs in its own worker process
+    try:
+        status = protocol.ImageInsert(job["text"], job["cover"], options["cipherMode"], 1, options["paranoid"],
+                                      options["channelBits"], options["codec"], job["pin"], job.get("output") or None)
+    except Exception:
+        return job, "error", 0, time.time() - start
+    return job, status, size, time.time() - start
+
+
+def runExtract(job):
+    """ Run one extract job in a worker process, returns the job, its status code, the text size and the seconds it took """
+    start = time.time()
+    if job.get("status"):
+        return job, job["status"], 0, 0.0
+
+    image = job["image"]
+    output = job.get("output") or os.path.splitext(image)[0] + ".txt"
+
+    # The text file only shows up once it has been completely written, a failed extraction leaves whatever file was there alone
+    try:
+        with preFile.atomicWrite(output) as textOut:
+            status = protocol.ImageExtract(image, job["pin"], False, textOut, 1, image)
+            if status != "cleared":
+                raise ExtractFailed(status)
+        size = os.path.getsize(output)
+    except ExtractFailed as failed:
+        return job, failed.args[0], 0, time.time() - start
+    except (IOError, OSError):
+        return job, "text", 0, time.time() - start
+    except Exception:
+        return job, "error", 0, time.time() - start
+
+    return job, "Done", size, time.time() - start
+
+
+def runJobs(jobs, routine, workers):
+    """ Run every job with the routine over a pool of worker processes, printing a line per job as it finishes.
+
+    Returns a dictionary with the number of jobs per status code, the bytes of text handled and the seconds it all took.
+    """
+
+    start = time.time()
+    counts = {}
+    handled = 0
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for job, status, size, seconds in pool.imap_unordered(routine, jobs):
+            counts[status] = counts.get(status, 0) + 1
+            if status == "Done":
+                handled += size
+            print "%-8s %8.3fs  %s" % (status, seconds, job.get("text") or job.get("image") or "manifest row %d" % job["row"])
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    return {"counts": counts, "bytes": handled, "seconds": time.time() - start}
+
+
+def main(argv=None):
+    """ Read the command line, set up the jobs and run them """
+
+    parser = argparse.ArgumentParser(description="Hide text files in images, or pull them back out, without any prompts.")
+    parser.add_argument("routine", choices=["insert", "extract"])
+    parser.add_argument("--manifest", help="CSV or JSON manifest of the jobs")
+    parser.add_argument("--texts", help="directory of text files to insert")
+    parser.add_argument("--covers", help="directory of .png cover images, one per text file with the same name")
+    parser.add_argument("--images", help="directory of _encode.png images to extract")
+    parser.add_argument("--out", default=".", help="directory the extracted text files are written to")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--pin-env", default="HIDDEN_PIN", help="environment variable holding the pin")
+    parser.add_argument("--pin-fd", type=int, help="file descriptor to read the pin from instead")
+    parser.add_argument("--cipher-mode", choices=[AES.CIPHER_CBC, AES.CIPHER_CTR], default=AES.CIPHER_CBC)
+    parser.add_argument("--channel-bits", type=int, choices=[1, 2, 3, 4])
+    parser.add_argument("--codec", choices=["zlib", "bz2", "lzma", "auto"])
+    parser.add_argument("--paranoid", action="store_true", help="also decode and decrypt every saved image")
+    args = parser.parse_args(argv)
+
+    pin = readPin(args.pin_env, args.pin_fd)
+    if pin == None:
+        print "A 16 character long pin that can mask a key is needed, in $%s or on --pin-fd" % args.pin_env
+        return 2
+
+    if args.manifest:
+        jobs = readManifest(args.manifest, REQUIRED_COLUMNS[args.routine])
+    elif args.routine == "insert" and args.texts and args.covers:
+        jobs = pairDirectories(args.texts, args.covers)
+    elif args.routine == "extract" and args.images:
+        jobs = listImages(args.images, args.out)
+    else:
+        parser.error("give a --manifest, or --texts and --covers to insert, or --images to extract")
+
+    options = {"cipherMode": args.cipher_mode, "channelBits": args.channel_bits, "codec": args.codec, "paranoid": args.paranoid}
+    for job in jobs:
+        job["pin"] = pin
+        job["options"] = options
+
+    routine = runInsert if args.routine == "insert" else runExtract
+    results = runJobs(jobs, routine, max(1, args.workers))
+
+    print
+    for status in sorted(results["counts"]):
+        print "%-8s %d" % (status, results["counts"][status])
+    seconds = max(results["seconds"], 1e-6)
+    print "%d jobs in %.2fs, %.1f jobs/s, %.2f MB/s of text" % (len(jobs), seconds, len(jobs) / seconds,
+                                                                 results["bytes"] / 1048576.0 / seconds)
+
+    if results["counts"].get("Done", 0) == len(jobs):
+        return 0
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,845 @@
+# Description
+# Time the building blocks of the hidden encryption process so changes to them can be measured and compared.
+#
+# Key masking:
+#   Mask and unmask a set of random key seeds and pins once with the per call routines maskKey/unMaskKey
+#   and once with the batch routines maskKeys/unMaskKeys, then report the keys handled per second by each.
+#
+# AES:
+#   Encrypt and decrypt a file of random bytes with each of a set of read block sizes and report the MB/s of each.
+#
+# CTR:
+#   Encrypt and decrypt a file of random bytes in CTR mode with 1, 2, 4, ... worker processes up to the number of cores,
+#   next to CBC mode, and report the MB/s of each so the scaling with the core count can be seen.
+#
+# LSB:
+#   Encode and decode a payload of random bytes into a random cover image with one bit per blue color (version 2 format)
+#   and with 1 to 4 bits per red, green and blue color (version 3 format), and report the pixels touched and MB/s of each.
+#
+# Compression:
+#   Compress a made up log file with every installed codec and report the compressed size as a fraction of the original,
+#   the compress MB/s and the codec pickCodec picks.
+#   Then run texts whose compressed size is a multiple of 16 bytes, so their last CBC block is nothing but padding,
+#   through every codec, encryption, decryption and decompression, and exit with 1 when any of them doesn't come back whole.
+#
+# Memory:
+#   Embed a payload into a random cover image in a fresh process and report the peak memory the embed added, next to the size of the
+#   decoded image.  The peak must stay within EMBED_MEMORY_BUDGET times the decoded image size, the run exits with 1 when it doesn't.
+#   The embed runs once on one process and once in stripes over every core, with a payload large enough to be striped.
+#   Python 2 has no tracemalloc, so the peak resident size of the process is read with the resource module instead.
+#
+# Stress:
+#   Hide a set of text files in a set of images, then run many extractions at the same time from a pool of threads,
+#   some into their own file objects and some into the shared TextFromImage.txt, while other threads keep hiding texts in the same image.
+#   Every extraction must give back one whole text file and the shared image must always hold one whole text.
+#   Reports the number of extractions and inserts, how many of them gave a wrong result and how many raised,
+#   and exits with 1 when any of them did either.
+#
+# Imports:
+#   Import RunProtocol in fresh processes and report the median import time, which must stay within IMPORT_BUDGET_MS,
+#   and check that none of the heavy libraries in LAZY_MODULES were imported along with it, exiting with 1 when either check fails.
+#   Python 2 has no -X importtime, so the import is timed inside each process.
+#
+# Stripes:
+#   Encode and decode a payload filling a random cover with the serial LSB engine and with the striped engine over 1, 2, 4, ...
+#   worker processes up to the number of cores, and report the encode and decode times and whether each image matches the serial one.
+#
+# Suite:
+#   Make random RGBA covers and random payloads of the sizes in a profile, the same every run, and time key masking and unmasking,
+#   AES encryption and decryption, LSB encoding and decoding and the whole ImageInsert and ImageExtract routines over them.
+#   Each stage runs in a fresh process, so the peak memory it adds is its own.  Stages that read what another stage makes,
+#   such as decode reading the image encode saves, have those files made by that stage in a process before theirs.
+#   The payloads are encoded with the info string ImageInsert would pack for them.  The quick profile takes seconds,
+#   the full profile covers 1 to 100 megapixels and 1 KB to 100 MB payloads, skipping payloads a cover can't hold.
+#   Reports the latency percentiles, throughput and peak memory of every stage and size, and saves them as JSON when a file is named.
+#   compare reads two saved runs and lists every stage whose median latency or peak memory grew by more than REGRESSION_THRESHOLD,
+#   exiting with 1 when there are any.  findRegressions does the same for a test.
+#
+# Run with: python RunBenchmarks.py [keys COUNT | aes MEGABYTES | ctr MEGABYTES | lsb MEGABYTES | compress MEGABYTES | memory MEGAPIXELS |
+#                                    stress THREADS | imports RUNS | stripes MEGAPIXELS | suite [quick | full] [FILE] | compare BASELINE CURRENT [THRESHOLD]]
+
+
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import numpy
+from PIL import Image
+
+import KeyModifer as keyMod
+import LSBhinding as LSB
+import preFileProcess as preFile
+import RunProtocol as protocol
+import pycroptoEcrDecr as AES
+
+
+# Read block sizes tried by the AES benchmark
+AES_BLOCK_SIZES = [2048, 16 << 10, 64 << 10, 256 << 10, 1 << 20, 4 << 20]
+
+# Largest peak memory an embed may add, as a multiple of the decoded cover image size
+EMBED_MEMORY_BUDGET = 1.5
+
+# Longest RunProtocol may take to import, and the libraries it must not import until they are used
+IMPORT_BUDGET_MS = 30
+LAZY_MODULES = ["Tkinter", "tkFileDialog", "numpy", "PIL.Image", "Crypto", "LSBhinding", "KeyModifer", "pycroptoEcrDecr"]
+
+# Cover sizes in megapixels, payload sizes in bytes, timed runs per stage and keys masked by the suite
+SUITE_PROFILES = {"quick": {"megapixels": [1], "payloads": [1 << 10, 64 << 10, 1 << 20], "runs": 5, "keys": 200},
+                  "full": {"megapixels": [1, 10, 100], "payloads": [1 << 10, 1 << 20, 10 << 20, 100 << 20], "runs": 5, "keys": 1000}}
+
+# The stage each stage's files are made by, run in a process of its own before the stage is timed
+SUITE_SETUP = {"decrypt": "encrypt", "decode": "encode", "extract": "insert"}
+
+# Fraction the median latency or peak memory of a stage may grow by before compare calls it a regression
+REGRESSION_THRESHOLD = 0.2
+
+
+def randomKeys(count, seed):
+    """ Build count random key seeds and count invertable pins, the same random seed always gives the same keys """
+
+    rng = random.Random(seed)
+    keySeeds = []
+    pins = []
+    while len(pins) < count:
+        pin = [rng.randint(33, 126) for i in range(16)]
+        if keyMod.invertable(pin):
+            continue
+        pins.append(pin)
+        keySeeds.append([rng.randint(0, 255) for i in range(16)])
+    return keySeeds, pins
+
+
+def timeCall(function, *args):
+    """ Run the function once and return the seconds it took along with its result """
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+
+def benchmarkKeyMasking(count):
+    """ Compare the per call and the batch key masking routines on count keys.
+
+    Returns a dictionary with the keys per second of each routine and whether both routines gave the same storage keys and key seeds.
+    """
+
+    keySeeds, pins = randomKeys(count, 0)
+
+    maskTime, single = timeCall(lambda: [keyMod.maskKey(keySeeds[i], pins[i])[1] for i in range(count)])
+    batchMaskTime, batch = timeCall(keyMod.maskKeys, keySeeds, pins)
+    unMaskTime, singleBack = timeCall(lambda: [keyMod.unMaskKey(single[i], pins[i]) for i in range(count)])
+    batchUnMaskTime, batchBack = timeCall(keyMod.unMaskKeys, batch[1], pins)
+
+    return {"keys": count,
+            "maskKey": count / maskTime,
+            "maskKeys": count / batchMaskTime,
+            "unMaskKey": count / unMaskTime,
+            "unMaskKeys": count / batchUnMaskTime,
+            "match": single == batch[1] and singleBack == batchBack == keySeeds}
+
+
+class NullFile(object):
+    """ File object that throws away everything written to it, while counting the bytes """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+
+def benchmarkAES(megabytes, blockSizes):
+    """ Encrypt and decrypt a file of random bytes with each read block size.
+
+    Returns a list with a dictionary per block size holding the encrypt and decrypt MB/s.
+    """
+
+    key = AES.generateKey()[0]
+    handle, fileName = tempfile.mkstemp(suffix=".bin")
+    results = []
+    try:
+        with os.fdopen(handle, "wb") as fout:
+            for i in range(megabytes):
+                fout.write(os.urandom(1 << 20))
+
+        for sz in blockSizes:
+            cipherFile = fileName + ".cipher"
+            encryptTime, nothing = timeCall(AES.encrypt, fileName, cipherFile, sz, key)
+
+            clean = NullFile()
+            with open(cipherFile, "rb") as fin:
+                decryptTime, nothing = timeCall(AES.decryptStream, iter(lambda: fin.read(sz), ''), key, clean, 0)
+            os.remove(cipherFile)
+
+            results.append({"blockSize": sz,
+                            "encrypt": megabytes / encryptTime,
+                            "decrypt": megabytes / decryptTime,
+                            "match": clean.size == megabytes << 20})
+    finally:
+        os.remove(fileName)
+
+    return results
+
+
+def workerCounts():
+    """ Worker counts tried by the CTR benchmark, powers of two up to the number of cores and the number of cores itself """
+    cores = multiprocessing.cpu_count()
+    counts = []
+    workers = 1
+    while workers < cores:
+        counts.append(workers)
+        workers *= 2
+    return counts + [cores]
+
+
+def benchmarkCTR(megabytes, counts):
+    """ Encrypt and decrypt a file of random bytes in CBC mode and in CTR mode with each worker count.
+
+    Returns a list with a dictionary per run holding the mode, the worker count and the encrypt and decrypt MB/s.
+    """
+
+    key = AES.generateKey()[0]
+    handle, fileName = tempfile.mkstemp(suffix=".bin")
+    results = []
+    try:
+        with os.fdopen(handle, "wb") as fout:
+            for i in range(megabytes):
+                fout.write(os.urandom(1 << 20))
+
+        runs = [(AES.CIPHER_CBC, 1)] + [(AES.CIPHER_CTR, workers) for workers in counts]
+        for mode, workers in runs:
+            cipherFile = fileName + ".cipher"
+            encryptTime, nothing = timeCall(AES.encrypt, fileName, cipherFile, AES.DEFAULT_BLOCK_SIZE, key, mode, workers)
+
+            clean = NullFile()
+            with open(cipherFile, "rb") as fin:
+                decryptTime, nothing = timeCall(AES.decryptStream, iter(lambda: fin.read(AES.DEFAULT_BLOCK_SIZE), ''),
+                                                key, clean, 0, workers)
+            os.remove(cipherFile)
+
+            results.append({"mode": mode,
+                            "workers": workers,
+                            "encrypt": megabytes / encryptTime,
+                            "decrypt": megabytes / decryptTime,
+                            "match": clean.size == megabytes << 20})
+    finally:
+        os.remove(fileName)
+
+    return results
+
+
+def benchmarkChannelBits(megabytes):
+    """ Encode and decode a payload of random bytes with one bit per blue color and with 1 to 4 bits per color.
+
+    The cover is just large enough for the payload in the version 2 format.
+    Returns a list with a dictionary per format holding the bits per color, the pixels touched and the encode and decode MB/s.
+    """
+
+    payload = os.urandom(megabytes << 20)
+    side = int((len(payload) * 8 + 1000) ** 0.5) + 1
+    handle, coverName = tempfile.mkstemp(suffix=".png")
+    os.close(handle)
+    encodedName = coverName[:-4] + "_encode" + coverName[-4:]
+    results = []
+    try:
+        Image.fromarray(numpy.random.randint(0, 256, (side, side, 4)).astype(numpy.uint8), 'RGBA').save(coverName)
+
+        for channelBits in [None, 1, 2, 3, 4]:
+            chunks = [payload[i:i + AES.DEFAULT_BLOCK_SIZE] for i in range(0, len(payload), AES.DEFAULT_BLOCK_SIZE)]
+            encodeTime, status = timeCall(LSB.encodeStream, coverName, chunks, len(payload), "[0]|0|0", True, channelBits)
+            decodeTime, message = timeCall(lambda: ''.join(LSB.decodeStream(encodedName)[1]))
+
+            results.append({"channelBits": channelBits or 0,
+                            "pixels": LSB.messageStart(7, channelBits) + LSB.messagePixels(len(payload), channelBits),
+                            "encode": megabytes / encodeTime,
+                            "decode": megabytes / decodeTime,
+                            "match": status == "Completed!" and message == payload})
+    finally:
+        for name in (coverName, encodedName):
+            if os.path.exists(name):
+                os.remove(name)
+
+    return results
+
+
+def benchmarkCompression(megabytes):
+    """ Compress a made up log file of about the given size with every installed codec.
+
+    Returns the codec pickCodec picks and a list with a dictionary per codec holding the size ratio and compress MB/s.
+    """
+
+    rng = random.Random(0)
+    handle, fileName = tempfile.mkstemp(suffix=".txt")
+    results = []
+    try:
+        with os.fdopen(handle, "wb") as fout:
+            written = 0
+            while written < megabytes << 20:
+                line = "2019-12-%02d %02d:%02d:%02d %s worker %d handled request %d in %d ms\n" % (
+                    rng.randint(1, 31), rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59),
+                    rng.choice(["INFO", "INFO", "WARN", "ERROR"]), rng.randint(1, 8), rng.randint(0, 10 ** 6), rng.randint(1, 500))
+                fout.write(line)
+                written += len(line)
+
+        size = os.path.getsize(fileName)
+        for codec in sorted(preFile.CODECS):
+            compressTime, compressed = timeCall(preFile.compressFile, fileName, codec)
+            compressed[0].close()
+            results.append({"codec": codec,
+                            "ratio": float(compressed[1]) / size,
+                            "compress": megabytes / compressTime})
+        picked = preFile.pickCodec(fileName)
+    finally:
+        os.remove(fileName)
+
+    return picked, results
+
+
+def checkCodecRoundTrips(texts=4):
+    """ Compress, encrypt, decrypt and decompress random texts whose compressed size is a multiple of 16 bytes,
+        texts of them per codec and cipher mode.
+
+    Returns a dictionary of codec name to whether every text came back whole.
+    """
+
+    rng = random.Random(0)
+    key = AES.generateKey()[0]
+    handle, fileName = tempfile.mkstemp(suffix=".txt")
+    os.close(handle)
+    results = {}
+    try:
+        for codec in sorted(preFile.CODECS):
+            good = True
+            found = 0
+            while found < texts:
+                text = "".join([rng.choice("abcdefgh \n") for i in range(rng.randint(0, 4000))])
+                with open(fileName, "wb") as fout:
+                    fout.write(text)
+                compressed, size = preFile.compressFile(fileName, codec)
+                if size % 16 != 0:
+                    continue
+                found += 1
+
+                for mode in (AES.CIPHER_CBC, AES.CIPHER_CTR):
+                    compressed.seek(0)
+                    cipherText = "".join([str(block) for block in AES.encryptStream(io.BytesIO(compressed.getvalue()),
+                                                                                    AES.DEFAULT_BLOCK_SIZE, key, mode)])
+                    clean = io.BytesIO()
+                    try:
+                        textOut = preFile.DecompressFile(clean, codec)
+                        AES.decryptStream([cipherText], key, textOut, size)
+                        textOut.finish()
+                    except Exception:
+                        good = False
+                    good = good and clean.getvalue() == text
+            results[codec] = good
+    finally:
+        os.remove(fileName)
+
+    return results
+
+
+def peakMemory():
+    """ Peak resident size of this process in bytes, Linux reports it in kilobytes and Mac OS in bytes """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+def embedPeak(coverName, payloadBytes, workers, results):
+    """ Embed payloadBytes of random bytes into the cover with workers processes and put the peak memory the embed added
+        on the results queue """
+    payload = os.urandom(payloadBytes)
+    before = peakMemory()
+    LSB.encodeStream(coverName, [payload], payloadBytes, "[0]|0|0", True, None, None, workers)
+    results.put(peakMemory() - before)
+
+
+def benchmarkEmbedMemory(megapixels, payloadFraction=0.05, workers=1):
+    """ Embed a payload filling payloadFraction of a random cover of the given size, in a fresh process so the peak is its own.
+        With more than one worker the payload must cover at least LSB.STRIPE_MIN_PIXELS pixels for the embed to be striped.
+
+    Returns a dictionary with the decoded image size, the peak memory the embed added, whether the embed was striped
+    and whether it stayed within EMBED_MEMORY_BUDGET.
+    """
+
+    side = int((megapixels * 1000000) ** 0.5)
+    handle, coverName = tempfile.mkstemp(suffix=".png")
+    os.close(handle)
+    try:
+        Image.fromarray(numpy.random.randint(0, 256, (side, side, 4)).astype(numpy.uint8), 'RGBA').save(coverName)
+
+        results = multiprocessing.Queue()
+        payloadBytes = int(side * side * payloadFraction) // 8
+        worker = multiprocessing.Process(target=embedPeak, args=(coverName, payloadBytes, workers, results))
+        worker.start()
+        peak = results.get()
+        worker.join()
+    finally:
+        for name in (coverName, coverName[:-4] + "_encode" + coverName[-4:]):
+            if os.path.exists(name):
+                os.remove(name)
+
+    imageBytes = side * side * 4
+    return {"imageBytes": imageBytes,
+            "peakBytes": peak,
+            "ratio": float(peak) / imageBytes,
+            "striped": workers > 1 and LSB.messagePixels(payloadBytes, None) >= LSB.STRIPE_MIN_PIXELS,
+            "withinBudget": peak <= EMBED_MEMORY_BUDGET * imageBytes}
+
+
+def stressExtraction(threads, rounds=20, images=4):
+    """ Run threads threads at once, each doing rounds extractions or inserts, and check every result.
+
+    Returns a dictionary with the number of extractions and inserts run, the number that gave a wrong result
+    and the number that raised an exception.
+    """
+
+    pin = randomKeys(1, 1)[1][0]
+    workDir = tempfile.mkdtemp()
+    startDir = os.getcwd()
+    counts = {"extractions": 0, "inserts": 0, "wrong": 0, "failed": 0}
+    countLock = threading.Lock()
+
+    try:
+        os.chdir(workDir)
+        texts = []
+        for i in range(images):
+            texts.append(os.urandom(2000 + 500 * i))
+            with open("text%d.txt" % i, "wb") as fout:
+                fout.write(texts[-1])
+            Image.fromarray(numpy.random.randint(0, 256, (200, 200, 4)).astype(numpy.uint8), 'RGBA').save("cover%d.png" % i)
+            protocol.ImageInsert("text%d.txt" % i, "cover%d.png" % i, workers=1, pin=pin)
+
+        def worker(number):
+            for r in range(rounds):
+                i = (number + r) % images
+                kind = (number + r) % 3
+                failed = False
+                try:
+                    if kind == 0:
+                        textOut = io.BytesIO()
+                        good = protocol.ImageExtract("cover%d.png" % i, pin, False, textOut, 1) == "cleared" and textOut.getvalue() == texts[i]
+                    elif kind == 1:
+                        # Every thread shares TextFromImage.txt, so it may hold any of the texts but always one whole text
+                        good = protocol.ImageExtract("cover%d.png" % i, pin, False, workers=1) == "cleared"
+                        with open("TextFromImage.txt", "rb") as fin:
+                            good = good and fin.read() in texts
+                    else:
+                        good = protocol.ImageInsert("text%d.txt" % i, "cover0.png", workers=1, pin=pin, encodedName="shared.png") == "Done"
+                        textOut = io.BytesIO()
+                        good = good and protocol.ImageExtract("cover0.png", pin, False, textOut, 1, "shared.png") == "cleared"
+                        good = good and textOut.getvalue() in texts
+                except Exception:
+                    good = False
+                    failed = True
+
+                with countLock:
+                    counts["inserts" if kind == 2 else "extractions"] += 1
+                    counts["wrong"] += not good and not failed
+                    counts["failed"] += failed
+
+        running = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+        for thread in running:
+            thread.start()
+        for thread in running:
+            thread.join()
+    finally:
+        os.chdir(startDir)
+        shutil.rmtree(workDir)
+
+    return counts
+
+
+def benchmarkImports(runs):
+    """ Import RunProtocol in runs fresh processes.
+
+    Returns a dictionary with the median import time in milliseconds, the lazy modules that were imported anyway
+    and whether the import stayed within the budget.
+    """
+
+    script = ("import sys, time\n"
+              "start = time.time()\n"
+              "import RunProtocol\n"
+              "print (time.time() - start) * 1000\n"
+              "print ','.join([name for name in %r if name in sys.modules])\n" % LAZY_MODULES)
+
+    times = []
+    loaded = set()
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(__file__)))
+        lines = output.splitlines()
+        times.append(float(lines[0]))
+        if len(lines) > 1 and lines[1]:
+            loaded.update(lines[1].split(","))
+
+    times.sort()
+    median = times[len(times) // 2]
+    return {"median": median,
+            "loaded": sorted(loaded),
+            "withinBudget": median <= IMPORT_BUDGET_MS and not loaded}
+
+
+def benchmarkStripes(megapixels, counts):
+    """ Encode and decode a payload filling a random cover with 2 bits per color, with the serial engine
+        and with the striped engine over each worker count.
+
+    Returns a list with a dictionary per run holding the worker count, 1 for the serial engine, the encode and decode seconds,
+    the speed up over the serial engine and whether the image and message match the serial ones.
+    """
+
+    workDir = tempfile.mkdtemp()
+    coverName = os.path.join(workDir, "cover.png")
+    serialName = os.path.join(workDir, "serial.png")
+    results = []
+    try:
+        makeCover(coverName, megapixels, 0)
+        size = LSB.capacity(coverName, 2, 16)[0]
+        payload = numpy.random.RandomState(0).bytes(size)
+        chunks = [payload[i:i + AES.DEFAULT_BLOCK_SIZE] for i in range(0, size, AES.DEFAULT_BLOCK_SIZE)]
+
+        # The striped engine is only used with more than one worker, so one worker is the serial engine
+        for workers in [1] + [count for count in counts if count > 1]:
+            encodedName = os.path.join(workDir, "encoded%d.png" % workers) if workers > 1 else serialName
+            encodeTime, status = timeCall(LSB.encodeStream, coverName, chunks, size, "[0]|0|0", True, 2, encodedName, workers)
+            decodeTime, message = timeCall(lambda: ''.join(LSB.decodeStream(encodedName, workers)[1]))
+            with open(serialName, "rb") as serial:
+                with open(encodedName, "rb") as encoded:
+                    same = serial.read() == encoded.read()
+            results.append({"workers": workers,
+                            "encode": encodeTime,
+                            "decode": decodeTime,
+                            "encodeSpeedUp": results[0]["encode"] / encodeTime if results else 1.0,
+                            "decodeSpeedUp": results[0]["decode"] / decodeTime if results else 1.0,
+                            "match": status == "Completed!" and message == payload and same})
+    finally:
+        shutil.rmtree(workDir)
+
+    return results
+
+
+def latencyPercentiles(times):
+    """ 50th, 90th and 99th percentile of a list of seconds, in milliseconds """
+    times = sorted(times)
+    return dict((label, times[min(len(times) - 1, int(fraction * len(times)))] * 1000)
+                for label, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)))
+
+
+def makeCover(fileName, megapixels, seed):
+    """ Save a random RGBA cover of about the given number of megapixels, the same seed always gives the same cover """
+    side = int((megapixels * 1000000) ** 0.5)
+    rng = numpy.random.RandomState(seed)
+    Image.fromarray(rng.randint(0, 256, (side, side, 4)).astype(numpy.uint8), 'RGBA').save(fileName)
+
+
+def makePayload(fileName, size, seed):
+    """ Write size random bytes into the file a megabyte at a time, the same seed always gives the same bytes """
+    rng = numpy.random.RandomState(seed)
+    with open(fileName, "wb") as fout:
+        for start in range(0, size, 1 << 20):
+            fout.write(rng.bytes(min(1 << 20, size - start)))
+
+
+def pickChannelBits(coverName, size, infoLength):
+    """ Fewest bits per color that fit the cipher text of a size byte payload and an info string into the cover, None for blue only,
+        or False when it doesn't fit at all """
+    for channelBits in [None, 1, 2, 3, 4]:
+        messageRoom, infoRoom = LSB.capacity(coverName, channelBits, infoLength)
+        if messageRoom >= AES.cipherLength(size) and infoRoom >= infoLength:
+            return channelBits
+    return False
+
+
+def stageCall(stage, case, workDir):
+    """ Set up one stage of a suite case and return a function that runs the stage once and returns whether it worked.
+        A stage listed in SUITE_SETUP reads the files its setup stage left in workDir."""
+
+    payloadName = case.get("payloadName")
+    coverName = case.get("coverName")
+    channelBits = case.get("channelBits")
+    size = case.get("payloadBytes", 0)
+    cipherName = os.path.join(workDir, "cipher.bin")
+    encodedName = os.path.join(workDir, "encoded.png")
+    key = case.get("key")
+    pin = case.get("pin")
+
+    if stage in ("maskKey", "unMaskKey"):
+        keySeeds, pins = randomKeys(case["keys"], 0)
+        storageKeys = [keyMod.maskKey(keySeeds[i], pins[i])[1] for i in range(len(pins))]
+        turn = itertools.count()
+        def maskKey():
+            i = next(turn) % len(pins)
+            if stage == "maskKey":
+                return keyMod.maskKey(keySeeds[i], pins[i])[1] == storageKeys[i]
+            return keyMod.unMaskKey(storageKeys[i], pins[i]) == keySeeds[i]
+        return maskKey
+
+    if stage == "encrypt":
+        def encrypt():
+            AES.encrypt(payloadName, cipherName, AES.DEFAULT_BLOCK_SIZE, key)
+            return os.path.getsize(cipherName) == AES.cipherLength(size)
+        return encrypt
+    if stage == "decrypt":
+        def decrypt():
+            clean = NullFile()
+            with open(cipherName, "rb") as fin:
+                AES.decryptStream(iter(lambda: fin.read(AES.DEFAULT_BLOCK_SIZE), ''), key, clean, size)
+            return clean.size == size
+        return decrypt
+
+    if stage in ("encode", "decode"):
+        with open(payloadName, "rb") as fin:
+            payload = fin.read()
+        if stage == "encode":
+            return lambda: LSB.encodeStream(coverName, [payload], size, case["info"], True, channelBits, encodedName) == "Completed!"
+        return lambda: ''.join(LSB.decodeStream(encodedName)[1]) == payload
+
+    if stage == "insert":
+        return lambda: protocol.ImageInsert(payloadName, coverName, AES.CIPHER_CBC, 1, False, channelBits, None, pin,
+                                            encodedName) == "Done"
+    def extract():
+        clean = NullFile()
+        return protocol.ImageExtract(coverName, pin, False, clean, 1, encodedName) == "cleared" and clean.size == size
+    return extract
+
+
+def setupStage(stage, case, workDir):
+    """ Run the setup stage of a stage once in this process, leaving the files the stage reads in workDir """
+    stageCall(SUITE_SETUP[stage], case, workDir)()
+
+
+def runStage(stage, case, runs, workDir, results):
+    """ Time runs runs of one stage in this process and put the seconds of each run, whether they all worked
+        and the peak memory they added on the results queue """
+    call = stageCall(stage, case, workDir)
+    before = peakMemory()
+    times = []
+    good = True
+    for i in range(runs):
+        seconds, worked = timeCall(call)
+        times.append(seconds)
+        good = good and worked
+    results.put((times, good, peakMemory() - before))
+
+
+def benchmarkSuite(profile):
+    """ Time every stage over every cover and payload size of the profile, each stage in a fresh process so its peak memory is its own.
+
+    Returns a dictionary describing the machine and the run, with a list holding a dictionary per stage and size:
+    the latency percentiles in milliseconds, the runs per second, the payload MB/s, the peak memory added and whether every run worked.
+    """
+
+    settings = SUITE_PROFILES[profile]
+    workDir = tempfile.mkdtemp()
+    cases = [{"stage": stage, "keys": settings["keys"]} for stage in ("maskKey", "unMaskKey")]
+
+    # The payloads are encrypted with one key and pin, and encoded with the info string ImageInsert packs for them
+    key, keySeed = AES.generateKey()
+    pin = randomKeys(1, 1)[1][0]
+    storageKey = keyMod.maskKey(keySeed, pin)[1]
+    try:
+        for size in settings["payloads"]:
+            payloadName = os.path.join(workDir, "payload%d.bin" % size)
+            makePayload(payloadName, size, size)
+            for stage in ("encrypt", "decrypt"):
+                cases.append({"stage": stage, "payloadName": payloadName, "payloadBytes": size, "key": key})
+
+        for megapixels in settings["megapixels"]:
+            coverName = os.path.join(workDir, "cover%d.png" % megapixels)
+            makeCover(coverName, megapixels, megapixels)
+            for size in settings["payloads"]:
+                info = protocol.packInfo(storageKey, size, AES.cipherLength(size), None)
+                channelBits = pickChannelBits(coverName, size, len(info))
+                if channelBits == False:
+                    continue
+                for stage in ("encode", "decode", "insert", "extract"):
+                    cases.append({"stage": stage, "coverName": coverName, "megapixels": megapixels, "channelBits": channelBits,
+                                  "payloadName": os.path.join(workDir, "payload%d.bin" % size), "payloadBytes": size,
+                                  "info": info, "pin": pin})
+
+        results = []
+        for case in cases:
+            runs = settings["keys"] if case["stage"] in ("maskKey", "unMaskKey") else settings["runs"]
+            caseDir = tempfile.mkdtemp(dir=workDir)
+            if case["stage"] in SUITE_SETUP:
+                setup = multiprocessing.Process(target=setupStage, args=(case["stage"], case, caseDir))
+                setup.start()
+                setup.join()
+
+            queue = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=runStage, args=(case["stage"], case, runs, caseDir, queue))
+            worker.start()
+            times, good, peak = queue.get()
+            worker.join()
+            shutil.rmtree(caseDir)
+
+            result = {"stage": case["stage"], "megapixels": case.get("megapixels", 0), "payloadBytes": case.get("payloadBytes", 0),
+                      "channelBits": case.get("channelBits") or 0, "runs": runs, "perSecond": runs / sum(times),
+                      "mbPerSecond": case.get("payloadBytes", 0) * runs / 1048576.0 / sum(times), "peakBytes": peak, "match": good}
+            result.update(latencyPercentiles(times))
+            results.append(result)
+    finally:
+        shutil.rmtree(workDir)
+
+    return {"profile": profile, "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+            "platform": platform.platform(), "cores": multiprocessing.cpu_count(), "results": results}
+
+
+def resultKey(result):
+    return result["stage"], result["megapixels"], result["payloadBytes"]
+
+
+def findRegressions(baseline, current, threshold=REGRESSION_THRESHOLD):
+    """ Compare two benchmarkSuite results, such as one saved as JSON with a new run.
+
+    Returns a line for every stage and size whose median latency, or peak memory when it is more than a megabyte,
+    grew by more than the threshold fraction, or that stopped working.  An empty list means no regressions,
+    so a test can simply assert findRegressions(json.load(baselineFile), benchmarkSuite("quick")) == [].
+    """
+
+    before = dict((resultKey(result), result) for result in baseline["results"])
+    regressions = []
+    for result in current["results"]:
+        old = before.get(resultKey(result))
+        if old == None:
+            continue
+        name = "%s %.0f MP %d bytes" % resultKey(result)
+        if old["match"] and not result["match"]:
+            regressions.append("%s no longer works" % name)
+        if result["p50"] > old["p50"] * (1 + threshold):
+            regressions.append("%s median %.2f ms, was %.2f ms" % (name, result["p50"], old["p50"]))
+        if result["peakBytes"] > max(old["peakBytes"] * (1 + threshold), old["peakBytes"] + (1 << 20)):
+            regressions.append("%s peak memory %.1f MB, was %.1f MB" % (name, result["peakBytes"] / 1048576.0,
+                                                                     old["peakBytes"] / 1048576.0))
+    return regressions
+
+
+def main():
+    """ Run the benchmark named on the command line and print its results """
+
+    args = sys.argv[1:] or ["keys"]
+
+    if args[0] == "keys":
+        count = int(args[1]) if len(args) > 1 else 1000
+        results = benchmarkKeyMasking(count)
+        print "Key masking, %d keys" % count
+        print "maskKey    %10.0f keys/s" % results["maskKey"]
+        print "maskKeys   %10.0f keys/s  (%.1fx)" % (results["maskKeys"], results["maskKeys"] / results["maskKey"])
+        print "unMaskKey  %10.0f keys/s" % results["unMaskKey"]
+        print "unMaskKeys %10.0f keys/s  (%.1fx)" % (results["unMaskKeys"], results["unMaskKeys"] / results["unMaskKey"])
+        print "Same results: %s" % results["match"]
+    elif args[0] == "aes":
+        megabytes = int(args[1]) if len(args) > 1 else 64
+        print "AES, %d MB" % megabytes
+        print "block size    encrypt MB/s   decrypt MB/s"
+        for result in benchmarkAES(megabytes, AES_BLOCK_SIZES):
+            print "%10d  %13.1f  %13.1f" % (result["blockSize"], result["encrypt"], result["decrypt"])
+    elif args[0] == "ctr":
+        megabytes = int(args[1]) if len(args) > 1 else 256
+        print "AES modes, %d MB, %d cores" % (megabytes, multiprocessing.cpu_count())
+        print "mode  workers   encrypt MB/s   decrypt MB/s"
+        for result in benchmarkCTR(megabytes, workerCounts()):
+            print "%4s  %7d  %13.1f  %13.1f" % (result["mode"], result["workers"], result["encrypt"], result["decrypt"])
+    elif args[0] == "lsb":
+        megabytes = int(args[1]) if len(args) > 1 else 4
+        print "LSB, %d MB" % megabytes
+        print "bits per color       pixels   encode MB/s   decode MB/s"
+        results = benchmarkChannelBits(megabytes)
+        for result in results:
+            print "%14s  %11d  %12.1f  %12.1f" % (result["channelBits"] or "blue only", result["pixels"], result["encode"], result["decode"])
+        print "Same results: %s" % all(result["match"] for result in results)
+    elif args[0] == "compress":
+        megabytes = int(args[1]) if len(args) > 1 else 16
+        picked, results = benchmarkCompression(megabytes)
+        print "Compression, %d MB of log text" % megabytes
+        print "codec   size ratio   compress MB/s"
+        for result in results:
+            print "%5s  %11.3f  %14.1f" % (result["codec"], result["ratio"], result["compress"])
+        print "pickCodec picks: %s" % picked
+        roundTrips = checkCodecRoundTrips()
+        print "Round trips with a whole padding block: %s" % ", ".join(["%s %s" % item for item in sorted(roundTrips.items())])
+        if not all(roundTrips.values()):
+            return 1
+    elif args[0] == "stress":
+        threads = int(args[1]) if len(args) > 1 else 16
+        results = stressExtraction(threads)
+        print "Stress, %d threads" % threads
+        print "extractions %d, inserts %d, wrong results %d, failed %d" % (results["extractions"], results["inserts"], results["wrong"],
+                                                                             results["failed"])
+        if results["wrong"] or results["failed"]:
+            return 1
+    elif args[0] == "imports":
+        runs = int(args[1]) if len(args) > 1 else 11
+        result = benchmarkImports(runs)
+        print "Import RunProtocol, %d runs" % runs
+        print "median %.1f ms  (budget %d ms)" % (result["median"], IMPORT_BUDGET_MS)
+        print "Heavy libraries imported: %s" % (", ".join(result["loaded"]) or "none")
+        print "Within budget: %s" % result["withinBudget"]
+        if not result["withinBudget"]:
+            return 1
+    elif args[0] == "memory":
+        megapixels = float(args[1]) if len(args) > 1 else 16
+        workers = max(2, multiprocessing.cpu_count())
+        # The striped payload covers half the cover, or STRIPE_MIN_PIXELS pixels when that is more
+        stripedFraction = min(1.0, max(0.5, float(LSB.STRIPE_MIN_PIXELS) / (megapixels * 1000000)))
+        serial = benchmarkEmbedMemory(megapixels)
+        striped = benchmarkEmbedMemory(megapixels, stripedFraction, workers)
+        print "Embed memory, %.1f megapixels" % megapixels
+        print "decoded image  %8.1f MB" % (serial["imageBytes"] / 1048576.0)
+        for label, result in (("serial", serial), ("%d workers" % workers, striped)):
+            print "%-14s %8.1f MB  (%.2fx, budget %.2fx)" % (label, result["peakBytes"] / 1048576.0, result["ratio"], EMBED_MEMORY_BUDGET)
+        if not striped["striped"]:
+            print "The cover is too small for a striped embed, it took the serial path"
+        print "Within budget: %s" % (serial["withinBudget"] and striped["withinBudget"])
+        if not (serial["withinBudget"] and striped["withinBudget"]):
+            return 1
+    elif args[0] == "stripes":
+        megapixels = float(args[1]) if len(args) > 1 else 25
+        print "LSB stripes, %.0f megapixels, %d cores" % (megapixels, multiprocessing.cpu_count())
+        print "workers   encode s  speed up   decode s  speed up  same image"
+        for result in benchmarkStripes(megapixels, sorted(set(workerCounts() + [2]))):
+            print "%7d  %9.2f  %8.2f  %9.2f  %8.2f  %s" % (result["workers"], result["encode"], result["encodeSpeedUp"],
+                                                         result["decode"], result["decodeSpeedUp"], result["match"])
+    elif args[0] == "suite":
+        profile = args[1] if len(args) > 1 else "quick"
+        suite = benchmarkSuite(profile)
+        print "Suite, %s profile, %d cores" % (profile, suite["cores"])
+        print "stage        MP      payload  bits   runs    p50 ms    p90 ms    p99 ms    runs/s      MB/s   peak MB  works"
+        for result in suite["results"]:
+            print "%-9s  %4.0f  %11d  %4d  %5d  %8.2f  %8.2f  %8.2f  %8.1f  %8.1f  %8.1f  %s" % (
+                result["stage"], result["megapixels"], result["payloadBytes"], result["channelBits"], result["runs"],
+                result["p50"], result["p90"], result["p99"], result["perSecond"], result["mbPerSecond"],
+                result["peakBytes"] / 1048576.0, result["match"])
+        if len(args) > 2:
+            with open(args[2], "wb") as fout:
+                json.dump(suite, fout, indent=1, sort_keys=True)
+            print "Saved to " + args[2]
+    elif args[0] == "compare":
+        with open(args[1], "rb") as fin:
+            baseline = json.load(fin)
+        with open(args[2], "rb") as fin:
+            current = json.load(fin)
+        threshold = float(args[3]) if len(args) > 3 else REGRESSION_THRESHOLD
+        regressions = findRegressions(baseline, current, threshold)
+        for line in regressions:
+            print line
+        print "%d regressions over %d%%" % (len(regressions), threshold * 100)
+        if regressions:
+            return 1
+    else:
+        print "Unknown benchmark: " + args[0]
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,21 +17,69 @@
 #   LSB will be used to decoded the cipher text and info string out of the stego image.
 #   Brake the info string back into its components and unmask the key.
 #   With the unmasked key and IV from the cipher text use AES to decrypt the text.
+#
+# The info string is packed into bytes by packInfo:
+#   The 4 bytes "\x00HI" and 1, then a codec byte, the clean text length, the cipher text length, the number of masked key values
+#   and the masked key values, all as varints (7 bits per byte, lowest first, top bit set on every byte but the last),
+#   then a CRC-32 of everything before it.
+#   This is less than half the size of the old "[key, ...]|size|size" text and is read back without evaluating any text.
+#   Old info strings start with "[" so unpackInfo still reads them.
+#
+# Importing this file stays cheap so scripts and headless machines start fast:
+#   NumPy, PIL and PyCrypto, through LSB, AES and the key modification, are only imported the first time one of them is used.
+#   Tkinter is only imported when a file window is asked for, and every file window shares one hidden root window.
+#
+# ImageInsert and ImageExtract time each of their stages with Instrument, which records nothing unless a sink has been set.
+#
+# Shards:
+# ShardInsert splits the cipher text of one text file over an ordered set of cover images, in shares that fit each cover's room,
+# so a text file too large for any one cover can still be hidden.  Every image gets a version 4 LSB frame with a random set id,
+# its index and the number of shards, along with the same info string.  Each shard is handed to a worker process as soon as
+# the cipher text filling it has been made, so the images are encoded at the same time.
+# ShardExtract takes the images in any order, reads the shards in worker processes and hands each one to the AES decryption
+# as soon as every shard before it has been read, so the decryption starts before the last image has been read.
    
 
 
 # Import libraries
-from PIL import Image
-import Tkinter as tk
-import tkFileDialog
+import importlib
+import itertools
 import os
 import ast
+import struct
+import zlib
+
+class LazyModule(object):
+    """ Stand in for a module that imports the module the first time one of its names is used """
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module == None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
 
 # Import funcationalies
-import LSBhinding as LSB
-import preFileProcess as appendBuf
-import pycroptoEcrDecr as AES
-import KeyModifer as keyMod
+import preFileProcess as preFile
+import Instrument
+Image = LazyModule("PIL.Image")
+LSB = LazyModule("LSBhinding")
+AES = LazyModule("pycroptoEcrDecr")
+keyMod = LazyModule("KeyModifer")
+multiprocessing = LazyModule("multiprocessing")
+
+# Hidden Tk root window shared by every file window, made the first time a file window is opened
+tkRoot = None
+
+
+# Binary info string: magic and version, and the codecs by the number stored for them
+INFO_MAGIC = '\x00HI'
+INFO_VERSION = 1
+INFO_CODECS = [None, "zlib", "bz2", "lzma"]
+INFO_CHECKSUM = struct.Struct('>I')
 
 def Instructions():
     """ Display the instructions to the user """
@@ -81,8 +129,8 @@ def Instructions():
 def messageMeaning(errorMessage, phase):
     """ Display the meaning of the provided error message """
 
-    encryptionDic = {"image":"The image chose cannot be opened. ", "text":"The text file could not be open or buffered. ", "keyMask":"Key masking process failed. ", "aes":"AES encryption has failed. ", "lsb":"During the image encoding process an error occurred.", "key":"A check was made to make sure that the text file would be recoverable and a error was encountered during the AES decryption step.", "deCode":"A check was made to make sure that the text file would be recoverable and a general error was encountered."}
-    decryptionDic = {"info":"A problem with a file information string was encountered.", "aes":"AES decryption failed. ", "lsb":"During the image decoding phase an error occurred. ", "key":"Key unmasking process failed."}
+    encryptionDic = {"image":"The image chose cannot be opened. ", "text":"The text file could not be opened. ", "keyMask":"Key masking process failed. ", "aes":"AES encryption has failed. ", "lsb":"During the image encoding process an error occurred.", "size":"The image is too small to hold the text file. ", "codec":"The compression codec is not available. ", "key":"A check was made to make sure that the text file would be recoverable and a error was encountered during the AES decryption step.", "deCode":"A check was made to make sure that the text file would be recoverable and a general error was encountered."}
+    decryptionDic = {"info":"A problem with a file information string was encountered.", "aes":"AES decryption failed. ", "lsb":"During the image decoding phase an error occurred. ", "key":"Key unmasking process failed.", "codec":"The text was compressed with a codec that is not installed.", "shard":"The images are not exactly one whole set of shards."}
 
     if phase == 'e' or phase == 'E':
         if errorMessage in encryptionDic:
@@ -120,201 +168,689 @@ def helpPromp():
     
 
 
-def ImageInsert(tFileName, iFileName, reRun, pin):
+def promptPin():
+    """ Ask the user for a 16 character long pin until one that can be used to mask a key is entered.
+        Returns the pin as a list of character codes, or "exit" when the user enters exit."""
+
+    print
+    print "Enter a 16 character long pin/password for the text being hidden in the image"
+
+    while True:
+        pin = str(raw_input("> "))
+        if pin == "exit":
+            return "exit"
+        while len(pin) != 16:
+            print
+            print "Wrong length" 
+            print "Please enter a pin that is 16 characters long"
+            pin = str(raw_input("> "))
+
+        pin = [ord(pin[i]) for i in range(16)]
+
+        if keyMod.invertable(pin):
+            print
+            print "This pin will not work"
+            print "Please try another"
+        else:
+            return pin
+
+
+@Instrument.traced("insert")
+def ImageInsert(tFileName, iFileName, cipherMode=None, workers=None, paranoid=False, channelBits=None, codec=None,
+                pin=None, encodedName=None):
     """ Encrypt the file and then insert the cipher text into the image
+        cipherMode picks AES in CBC mode, the default, or in CTR mode, CTR mode spreads the encryption over workers processes,
+        one per core by default.  LSB encodes large images in stripes over the same number of processes.
+        channelBits picks how many cipher text bits LSB puts into each of the red, green and blue colors, 1 to 4,
+        without it only one bit goes into each blue color.
+        codec picks zlib, bz2 or lzma to compress the text file with before it is encrypted, or 'auto' to let the text file pick.
+        pin is the pin as a list of character codes, the user is asked for one when it isn't given.
+        encodedName is where the image is saved, next to the image with _encode added to its name when it isn't given.
     
     Steps:
-    1) Validate the image file and buffer the text file.
-    2) Generate a key for AES and get a pin from the user, then run the key masking routine on the keySeed
-    3) Encrypt the text file with the AES encryption routine
-    4) Create an infomation string out of the masked keySeed, original file text file size, and the cipher file size.
-    5) Encoded the cipher file and infomation string into the provided image useing LSB
-    6) Test the insertion step results in a clean extraction.
+    1) Validate the image file and the text file, compress the text file when asked to,
+       and check the image can hold the cipher text before any other work is done.
+    2) Generate a key for AES and get a pin from the user when none was given, then run the key masking routine on the keySeed
+       and check that the masked keySeed unmasks back into the keySeed.
+    3) Create an infomation string out of the masked keySeed, original file text file size, the cipher text size and the codec,
+       and check the image can hold the cipher text along with the infomation string.
+    4) Set up the AES encryption routine to hand back the cipher text of the text file one block at a time.
+    5) Encoded the cipher text blocks, as they come out of AES, and the infomation string into the provided image useing LSB
+       LSB checks the bits in the pixel array against the cipher text and infomation string before the image is saved.
+    6) When paranoid is set, also test the saved image results in a clean extraction by decoding and decrypting it.
     """
     
     # 1)
     # ---------------------------------------------------------------------------------------------------------------------------
-    if not reRun:
-        # Vaildate the Image file
-        try:
-            Image.open(iFileName)
-        except:
-            return 'image', ''
+    if cipherMode == None:
+        cipherMode = AES.CIPHER_CBC
+    if workers == None:
+        workers = AES.DEFAULT_WORKERS
 
-        # Append the buff to the inputted text file
-        messageBack = appendBuf.BufferBlock(tFileName)
-
-        # Check if the inputted text file didn't exist and/or there was an error appending the buffer to the text file
-        if messageBack == 'b':
-            return 'text', ''
+    # Vaildate the Image file
+    try:
+        cover = Image.open(iFileName)
+    except:
+        return 'image'
+
+    if cover.mode not in ('RGBA'):
+        print "Incorrect image mode"
+        return 'type'
+
+    # Check if the inputted text file didn't exist and/or can't be read
+    messageBack = preFile.CheckFile(tFileName)
+    if messageBack == 'b':
+        return 'text'
+
+    ogSize = os.path.getsize(tFileName)
+    plainText = tFileName
+    plainSize = ogSize
+    room = LSB.capacity(iFileName, channelBits)[0]
+
+    if codec == 'auto':
+        codec = preFile.pickCodec(tFileName)
+    if codec != None:
+        if codec not in preFile.CODECS:
+            return 'codec'
+        # The compressed text is only held in memory, and only until it has grown too large for the image
+        with Instrument.span("compress", codec=codec):
+            plainText, plainSize = preFile.compressFile(tFileName, codec, room)
+
+    # The cipher text length only depends on the text file size, so a text file too large for the image is turned away right here
+    fsz = AES.cipherLength(plainSize, cipherMode)
+    if room < fsz:
+        return 'size'
 
     # 2)
     # ---------------------------------------------------------------------------------------------------------------------------
 
     # Generate a key for the AES encryption
-    key, keySeed = AES.generateKey()
+    with Instrument.span("generateKey"):
+        key, keySeed = AES.generateKey()
 
-    if not reRun:
-        print
-        print "Enter a 16 character long pin/password for the text being hidden in the image"
-    
-    invertable = 'f'
-
-    while invertable != 't':
-        if not reRun:
-            pin = str(raw_input("> "))
-            
-            if pin == "exit":
-                return "exit", ""
+    if pin == None:
+        pin = promptPin()
+        if pin == "exit":
+            return "exit"
 
-            while len(pin) != 16:
-                print
-                print "Wrong length" 
-                print "Please enter a pin that is 16 characters long"
-                pin = str(raw_input("> "))
+    storageKey = maskKeySeed(keySeed, pin)
+    if storageKey == None:
+        return "keyMask"
 
-            pin = [ord(pin[i]) for i in range(16)]
+    # 3)
+    # ---------------------------------------------------------------------------------------------------------------------------
+    info = packInfo(storageKey, ogSize, fsz, codec)
 
-        try:
-            invertable, storageKey = keyMod.maskKey(keySeed, pin)
-        except:
-            return "keyMask", ''
+    messageRoom, infoRoom = LSB.capacity(iFileName, channelBits, len(info))
+    if messageRoom < fsz or infoRoom < len(info):
+        return 'size'
 
-    # 3)
+    # 4)
     # ---------------------------------------------------------------------------------------------------------------------------
 
     # Set the size of blocks read from the input file
-    # Name the outputted cipher file
-    readBlockSize = 2048
-    cFileName = tFileName[:-4] + "_cipher" + tFileName[-4:]
+    readBlockSize = AES.DEFAULT_BLOCK_SIZE
 
     try:
-        # Encrypt the user's file
-        AES.encrypt(tFileName, cFileName, readBlockSize, key)
+        # The user's file is only read and encrypted while the image encoding pulls on the cipher blocks
+        cipherBlocks = Instrument.timedChunks("encrypt", guardCipher(AES.encryptStream(plainText, readBlockSize, key, cipherMode, workers)))
     except:
-        return "aes", ''
-
-    # 4)
-    # ---------------------------------------------------------------------------------------------------------------------------
-    fsz = os.path.getsize(cFileName)
-    fsz += 100
-    text = open(cFileName, "rb").read(fsz)
-    info = str(storageKey) + "|" + str(os.path.getsize(tFileName)) + "|" + str(fsz)
+        return "aes"
 
     # 5)
     # ---------------------------------------------------------------------------------------------------------------------------
-    try:
-        messageBack = LSB.encode(iFileName, text, info)
-    except:
-        return "lsb", ''
+    # The encode span takes in the encryption, as the cipher blocks are only made while LSB pulls on them
+    with Instrument.span("encode", channelBits=channelBits):
+        try:
+            messageBack = LSB.encodeStream(iFileName, cipherBlocks, fsz, info, True, channelBits, encodedName, workers)
+        except CipherError:
+            return "aes"
+        except:
+            return "lsb"
 
-    if messageBack == "Completed!":
+    if messageBack == "Verification failed":
+        return 'deCode'
+    elif messageBack == "Image too small":
+        return 'size'
+    elif messageBack == "Completed!":
+        Instrument.count("bytesEncrypted", fsz)
 
         # 6)
         # -----------------------------------------------------------------------------------------------------------------------        
-        extractMessage = ImageExtract(iFileName, pin, True)
+        if not paranoid:
+            return 'Done'
+
+        extractMessage = ImageExtract(iFileName, pin, True, workers=workers, encodedName=encodedName)
         if extractMessage == "cleared":
-            return 'Done', ''
+            return 'Done'
         elif extractMessage == "aes":
-            reBuffer = appendBuf.BufferBlock(tFileName)
-            return 'key', ''
+            return 'key'
         else:
-            return 'deCode', pin
+            return 'deCode'
     else:
         print messageBack
-        return 'type', ''
+        return 'type'
 
 
-def ImageExtract(iFileName, pin, test):
+@Instrument.traced("extract")
+def ImageExtract(iFileName, pin, test, fOut=None, workers=None, encodedName=None):
     """ Pull the cipher text out of the image and then decrypt the file.
     
         Steps:
-        1) Decode the image with LSB to pullout the cipher text and infomation string.
+        1) Read the infomation string out of the image with LSB and set up the cipher text to be decoded a strip of rows at a time,
+           or in stripes by up to workers processes for a large image.
         2) Pull apart the infomation string and unmask the keySeed.
-        3) Writeout the cipher file and then decrypted the file using the AES decryption routine.
+        3) Decrypt the cipher text with the AES decryption routine while it is being decoded out of the image,
+           and decompress it when the infomation string names a codec.
+           The clean text is written to the file object fOut, or TextFromImage.txt when no file object is given.
+           TextFromImage.txt is only put in place once all of the text has been decrypted, so extractions can run at the same time.
+           The cipher mode is read from the cipher text, CTR mode cipher text is decrypted by up to workers processes, one per core by default.
     """
 
 
     # 1)
     # ---------------------------------------------------------------------------------------------------------------------------
-    try:
-        output, info = LSB.decode(iFileName[:-4] + "_encode" + iFileName[-4:])
-    except:
-        return "lsb"
+    if workers == None:
+        workers = AES.DEFAULT_WORKERS
+
+    # The image is read from encodedName, or from the image insertion made out of iFileName
+    if encodedName == None:
+        encodedName = iFileName[:-4] + "_encode" + iFileName[-4:]
+
+    with Instrument.span("readInfo"):
+        try:
+            info, cipherChunks = LSB.decodeStream(encodedName, workers)
+        except:
+            return "lsb"
 
     # 2)
     # ---------------------------------------------------------------------------------------------------------------------------
     try:
-        infoParts = info.split("|")
-        storageKey = ast.literal_eval(infoParts[0])
-        ogSize = int(infoParts[1])
-        fsz = int(infoParts[2])
+        storageKey, ogSize, fsz, codec = unpackInfo(info)
     except:
         return "info"
 
-    try:
-        keySeed = keyMod.unMaskKey(storageKey, pin)
-        key = [chr(keySeed[i]) for i in range(16)]
-        key = "".join(map(str, key))
-    except:
-        return "key"
+    if codec != None and codec not in preFile.CODECS:
+        return "codec"
+
+    with Instrument.span("unMaskKey"):
+        try:
+            keySeed = keyMod.unMaskKey(storageKey, pin)
+            key = [chr(keySeed[i]) for i in range(16)]
+            key = "".join(map(str, key))
+        except:
+            return "key"
 
     # 3)
     # ---------------------------------------------------------------------------------------------------------------------------
-    try:
-        n = len(output)
-        testOut = open("1Test.txt", "wb+")
-        if fsz > n:
-            testOut.write(output)
-        else:
-            testOut.write(output[:fsz])
-        testOut.close()
-    except:
-        return "file cipher file stetup"
+
+    # The decrypt span takes in reading the cipher text out of the image, which the readMessage span times on its own
+    cipherChunks = Instrument.timedChunks("readMessage", cipherChunks)
+    with Instrument.span("decrypt", codec=codec):
+        try:
+            if fOut != None:
+                decryptText(cipherChunks, key, fOut, ogSize, workers, codec)
+            elif test:
+                # We just want to check that the user's file will be recoverable in the future, so the clean text is thrown away
+                with open(os.devnull, "wb") as nullOut:
+                    decryptText(cipherChunks, key, nullOut, ogSize, workers, codec)
+            else:
+                with preFile.atomicWrite("TextFromImage.txt") as textOut:
+                    decryptText(cipherChunks, key, textOut, ogSize, workers, codec)
+        except:
+            return "aes"
+
+    Instrument.count("bytesDecrypted", fsz)
+    return "cleared"
+
+
+class CipherError(Exception):
+    """ Raised in place of an error the AES encryption raised while LSB was pulling on the cipher blocks """
+
+
+class ShardError(ValueError):
+    """ Raised while the shards of a set are read, carrying the status code ShardExtract hands back """
+
+
+@Instrument.traced("shardInsert")
+def ShardInsert(tFileName, iFileNames, cipherMode=None, workers=None, channelBits=None, codec=None, pin=None, encodedNames=None):
+    """ Encrypt the file and then split the cipher text over the images, one shard per image, in the order the images are given.
+        cipherMode, channelBits, codec and pin work the same way as for ImageInsert.
+        The shards are encoded by up to workers processes at the same time, one per core by default.
+        encodedNames are where the images are saved, next to each image with _encode added to its name when they aren't given.
+    
+    Steps:
+    1) Validate the image files and the text file, compress the text file when asked to,
+       and check the images can hold the cipher text between them.
+    2) Generate a key for AES, get a pin from the user when none was given and mask the keySeed.
+    3) Create the infomation string and split the cipher text length over the images, in proportion to the room each one has.
+    4) Encrypt the text file and hand each shard of the cipher text to a worker process as soon as it is complete,
+       to be encoded into its image with a random set id, the shard's index and the number of shards.
+    """
+
+    # 1)
+    # ---------------------------------------------------------------------------------------------------------------------------
+    if cipherMode == None:
+        cipherMode = AES.CIPHER_CBC
+    if workers == None:
+        workers = AES.DEFAULT_WORKERS
+    if encodedNames == None:
+        encodedNames = [name[:-4] + "_encode" + name[-4:] for name in iFileNames]
+    if not iFileNames or len(iFileNames) != len(encodedNames) or len(iFileNames) >= 1 << 16:
+        return "image"
+
+    for iFileName in iFileNames:
+        try:
+            cover = Image.open(iFileName)
+        except:
+            return 'image'
+        if cover.mode not in ('RGBA'):
+            print "Incorrect image mode"
+            return 'type'
+
+    if preFile.CheckFile(tFileName) == 'b':
+        return 'text'
+
+    ogSize = os.path.getsize(tFileName)
+    plainText = tFileName
+    plainSize = ogSize
+    room = sum([LSB.capacity(iFileName, channelBits, 0, True)[0] for iFileName in iFileNames])
+
+    if codec == 'auto':
+        codec = preFile.pickCodec(tFileName)
+    if codec != None:
+        if codec not in preFile.CODECS:
+            return 'codec'
+        with Instrument.span("compress", codec=codec):
+            plainText, plainSize = preFile.compressFile(tFileName, codec, room)
+
+    fsz = AES.cipherLength(plainSize, cipherMode)
+    if room < fsz:
+        return 'size'
+
+    # 2)
+    # ---------------------------------------------------------------------------------------------------------------------------
+    with Instrument.span("generateKey"):
+        key, keySeed = AES.generateKey()
+
+    if pin == None:
+        pin = promptPin()
+        if pin == "exit":
+            return "exit"
+
+    storageKey = maskKeySeed(keySeed, pin)
+    if storageKey == None:
+        return "keyMask"
+
+    # 3)
+    # ---------------------------------------------------------------------------------------------------------------------------
+    info = packInfo(storageKey, ogSize, fsz, codec)
+
+    rooms = [LSB.capacity(iFileName, channelBits, len(info), True) for iFileName in iFileNames]
+    if min([infoRoom for messageRoom, infoRoom in rooms]) < len(info):
+        return 'size'
+    lengths = shardLengths(fsz, [messageRoom for messageRoom, infoRoom in rooms])
+    if lengths == None:
+        return 'size'
+
+    # 4)
+    # ---------------------------------------------------------------------------------------------------------------------------
+    setId = os.urandom(LSB.SHARD_ID_SIZE)
+    count = len(iFileNames)
+
+    # Pool workers can't start processes of their own, so shards encoded in a pool run the serial LSB engine
+    pool = None
+    if workers > 1 and count > 1:
+        pool = multiprocessing.Pool(min(workers, count))
+        lsbWorkers = 1
+    else:
+        lsbWorkers = workers
 
     try:
-        outfile = "TextFromImage.txt"
-        AES.decrypt("1Test.txt", outfile, key, 2048, ogSize)
-    except:
+        with Instrument.span("encode", shards=count):
+            cipherBlocks = guardCipher(AES.encryptStream(plainText, AES.DEFAULT_BLOCK_SIZE, key, cipherMode, workers))
+            cipherBlocks = Instrument.timedChunks("encrypt", cipherBlocks)
+            messages = []
+            for index, blocks in enumerate(splitBlocks(cipherBlocks, lengths)):
+                job = (iFileNames[index], blocks, lengths[index], info, channelBits, encodedNames[index], (setId, index, count), lsbWorkers)
+                if pool != None:
+                    messages.append(pool.apply_async(insertShard, (job,)))
+                else:
+                    messages.append(insertShard(job))
+            if pool != None:
+                messages = [message.get() for message in messages]
+    except CipherError:
         return "aes"
+    except:
+        return "lsb"
+    finally:
+        if pool != None:
+            pool.terminate()
+            pool.join()
+
+    if "Verification failed" in messages:
+        return 'deCode'
+    elif "Image too small" in messages:
+        return 'size'
+    elif messages.count("Completed!") == count:
+        Instrument.count("bytesEncrypted", fsz)
+        return 'Done'
+    else:
+        return 'type'
 
-    if test:
-        # Delete the clean textfile as we just wanted to check that the user's file will be recoverable in the future
-        if os.path.exists(outfile):
-            os.remove(outfile)
 
+@Instrument.traced("shardExtract")
+def ShardExtract(iFileNames, pin, fOut=None, workers=None):
+    """ Pull the shards of a cipher text out of the images, given in any order, and then decrypt the file.
+        The clean text is written the same way as by ImageExtract.
+        Returns "shard" when the images don't hold exactly one whole set of shards.
+    
+        Steps:
+        1) Start reading the shards out of the images, in up to workers processes at the same time, one per core by default.
+        2) Pull apart the infomation string of the first shard read and unmask the keySeed.
+        3) Decrypt the shards in index order, each as soon as it and every shard before it has been read,
+           and decompress the clean text when the infomation string names a codec.
+    """
+
+    # 1)
+    # ---------------------------------------------------------------------------------------------------------------------------
+    if workers == None:
+        workers = AES.DEFAULT_WORKERS
+    if not iFileNames:
+        return "shard"
+
+    pool = None
+    if workers > 1 and len(iFileNames) > 1:
+        pool = multiprocessing.Pool(min(workers, len(iFileNames)))
+        shards = pool.imap_unordered(readShard, iFileNames)
+    else:
+        shards = itertools.imap(readShard, iFileNames)
+
+    try:
+        with Instrument.span("readInfo"):
+            try:
+                first = next(shards)
+            except:
+                return "lsb"
+
+        # 2)
+        # -----------------------------------------------------------------------------------------------------------------------
+        try:
+            storageKey, ogSize, fsz, codec = unpackInfo(first[1])
+        except:
+            return "info"
+
+        if codec != None and codec not in preFile.CODECS:
+            return "codec"
+
+        with Instrument.span("unMaskKey"):
+            try:
+                keySeed = keyMod.unMaskKey(storageKey, pin)
+                key = "".join([chr(keySeed[i]) for i in range(16)])
+            except:
+                return "key"
+
+        # 3)
+        # -----------------------------------------------------------------------------------------------------------------------
+        cipherChunks = Instrument.timedChunks("readShards", orderShards(first, shards))
+        with Instrument.span("decrypt", codec=codec):
+            try:
+                if fOut != None:
+                    decryptText(cipherChunks, key, fOut, ogSize, workers, codec)
+                else:
+                    with preFile.atomicWrite("TextFromImage.txt") as textOut:
+                        decryptText(cipherChunks, key, textOut, ogSize, workers, codec)
+            except ShardError as error:
+                return error.args[0]
+            except:
+                return "aes"
+    finally:
+        if pool != None:
+            pool.terminate()
+            pool.join()
+
+    Instrument.count("bytesDecrypted", fsz)
     return "cleared"
 
 
+def packVarint(number):
+    """ Pack a whole number into a varint, negative numbers are zigzagged into odd numbers first """
+    number = number * 2 if number >= 0 else -number * 2 - 1
+    packed = bytearray()
+    while number > 0x7F:
+        packed.append(0x80 | (number & 0x7F))
+        number >>= 7
+    packed.append(number)
+    return str(packed)
+
+
+def unpackVarint(data, position):
+    """ Read the varint starting at position in the bytearray data, returns the number and the position after it """
+    number = 0
+    shift = 0
+    while True:
+        if position >= len(data):
+            raise ValueError("Info string ends inside a number")
+        byte = data[position]
+        position += 1
+        number |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            break
+    number = number // 2 if number % 2 == 0 else -(number + 1) // 2
+    return number, position
+
+
+def packInfo(storageKey, ogSize, fsz, codec):
+    """ Pack the masked keySeed, clean text file size, cipher text size and codec into a binary info string with a checksum """
+    info = INFO_MAGIC + chr(INFO_VERSION) + chr(INFO_CODECS.index(codec))
+    info += packVarint(ogSize) + packVarint(fsz) + packVarint(len(storageKey))
+    info += "".join([packVarint(int(value)) for value in storageKey])
+    return info + INFO_CHECKSUM.pack(zlib.crc32(info) & 0xFFFFFFFF)
+
+
+def unpackInfo(info):
+    """ Pull apart an info string into the masked keySeed, clean text file size, cipher text size and codec.
+        Both binary info strings and old "[key, ...]|size|size" text info strings are read, a bad info string raises ValueError."""
+
+    if info.startswith("["):
+        infoParts = info.split("|")
+        codec = None
+        if len(infoParts) > 3:
+            codec = infoParts[3]
+        return ast.literal_eval(infoParts[0]), int(infoParts[1]), int(infoParts[2]), codec
+
+    if len(info) < len(INFO_MAGIC) + 2 + INFO_CHECKSUM.size or not info.startswith(INFO_MAGIC):
+        raise ValueError("Not an info string")
+    if ord(info[len(INFO_MAGIC)]) != INFO_VERSION:
+        raise ValueError("Unknown info string version")
+    if INFO_CHECKSUM.unpack(info[-INFO_CHECKSUM.size:])[0] != zlib.crc32(info[:-INFO_CHECKSUM.size]) & 0xFFFFFFFF:
+        raise ValueError("Info string checksum does not match")
+
+    data = bytearray(info[:-INFO_CHECKSUM.size])
+    codec = "unknown"
+    if data[len(INFO_MAGIC) + 1] < len(INFO_CODECS):
+        codec = INFO_CODECS[data[len(INFO_MAGIC) + 1]]
+
+    position = len(INFO_MAGIC) + 2
+    ogSize, position = unpackVarint(data, position)
+    fsz, position = unpackVarint(data, position)
+    count, position = unpackVarint(data, position)
+    storageKey = []
+    for i in range(count):
+        value, position = unpackVarint(data, position)
+        storageKey.append(value)
+    if position != len(data):
+        raise ValueError("Info string has bytes left over")
+
+    return storageKey, ogSize, fsz, codec
+
+
+def guardCipher(cipherBlocks):
+    """ Hand back the cipher blocks, turning an error raised while they are made into a CipherError,
+        so it is reported as an AES error and not as an error of the LSB encoding pulling on them """
+    try:
+        for block in cipherBlocks:
+            yield block
+    except Exception as error:
+        raise CipherError(error)
+
+
+def decryptText(cipherChunks, key, textOut, ogSize, workers, codec):
+    """ Decrypt the cipher text into the file object textOut, decompressing it on the way when a codec is given """
+    if codec != None:
+        textOut = preFile.DecompressFile(textOut, codec)
+
+    AES.decryptStream(cipherChunks, key, textOut, ogSize, workers)
+
+    if codec != None:
+        textOut.finish()
+
+
+def maskKeySeed(keySeed, pin):
+    """ Mask the keySeed with the pin and check the masked keySeed unmasks back into the keySeed.
+        Returns the masked keySeed, or None when the masking failed."""
+    with Instrument.span("maskKey"):
+        try:
+            invertable, storageKey = keyMod.maskKey(keySeed, pin)
+        except:
+            return None
+
+    if invertable != 't':
+        return None
+
+    # Make sure the key can be recovered before any of the encryption and image work is done, this only needs the 4x4 matrices
+    with Instrument.span("checkMask"):
+        if not keyMod.checkMask(keySeed, storageKey, pin):
+            return None
+    return storageKey
+
+
+def shardLengths(size, rooms):
+    """ Split size bytes over shards in proportion to the room each shard has, so the shards take about as long to encode.
+        Returns the length of each shard, or None when the rooms add up to less than size."""
+    total = sum(rooms)
+    if total < size:
+        return None
+    lengths = [size * room // total for room in rooms]
+
+    # Rounding down leaves a few bytes over, they go to the first shards with room to spare
+    left = size - sum(lengths)
+    for i in range(len(lengths)):
+        extra = min(left, rooms[i] - lengths[i])
+        lengths[i] += extra
+        left -= extra
+    return lengths
+
+
+def splitBlocks(blocks, lengths):
+    """ Regroup blocks of bytes into a list of blocks per length, handing each list back as soon as it is complete.
+        The blocks must add up to the sum of the lengths."""
+    index = 0
+    shard = []
+    filled = 0
+    for block in blocks:
+        while block:
+            while filled == lengths[index]:
+                yield shard
+                shard = []
+                filled = 0
+                index += 1
+                if index == len(lengths):
+                    raise ValueError("The blocks are longer than the shards")
+            take = min(len(block), lengths[index] - filled)
+            shard.append(block[:take])
+            block = block[take:]
+            filled += take
+
+    while index < len(lengths):
+        if filled != lengths[index]:
+            raise ValueError("The blocks are shorter than the shards")
+        yield shard
+        shard = []
+        filled = 0
+        index += 1
+
+
+def insertShard(job):
+    """ Encode one shard into its image, in a worker process when the shards are encoded at the same time """
+    iFileName, blocks, length, info, channelBits, encodedName, shard, workers = job
+    return LSB.encodeStream(iFileName, blocks, length, info, True, channelBits, encodedName, workers, shard)
+
+
+def readShard(iFileName):
+    """ Read one shard out of its image, in a worker process when the shards are read at the same time.
+        Returns the (set id, index, count) of the shard, its information string and its part of the cipher text."""
+    shard, info, chunks = LSB.decodeShard(iFileName)
+    return shard, info, "".join(chunks)
+
+
+def orderShards(first, shards):
+    """ Hand back the cipher text of a set of shards in index order, while the shards come in in any order.
+        first is the shard read first and shards the rest of them.
+        Raises ShardError with "lsb" when an image can't be read and with "shard" when the shards aren't exactly one whole set."""
+    setId, index, count = first[0]
+    info = first[1]
+    waiting = {}
+    nextIndex = 0
+    shard = first
+    while True:
+        (shardSet, index, shardCount), shardInfo, cipherText = shard
+        if shardSet != setId or shardCount != count or shardInfo != info or index < nextIndex or index in waiting:
+            raise ShardError("shard")
+        waiting[index] = cipherText
+        while nextIndex in waiting:
+            yield waiting.pop(nextIndex)
+            nextIndex += 1
+
+        try:
+            shard = next(shards)
+        except StopIteration:
+            break
+        except:
+            raise ShardError("lsb")
+
+    if nextIndex != count:
+        raise ShardError("shard")
+
+
+def askFileName(title, fileTypes):
+    """ Open a file window and return the name of the chosen file.
+        Tkinter is imported and the hidden root window is made the first time, after that the same root window is used."""
+    global tkRoot
+
+    import Tkinter as tk
+    import tkFileDialog
+
+    if tkRoot == None:
+        tkRoot = tk.Tk()
+        tkRoot.withdraw() # we don't want a full GUI, so keep the root window from appearing
+
+    return tkFileDialog.askopenfilename(parent = tkRoot, title = title, filetypes = fileTypes)
+
+
 def setupAndRunInsertion():
     """ Setup the infomation and run the test for the text into image routine.
     
     Steps
     1) Get the text file path and image file path from the user.
     2) Run the insertion routine and check that a valid extraction will be performable in the future.
-        Try three time and none are successful tell the user to try a large file.
+        The image's room is checked once, before any work is done, and a text file that doesn't fit comes back as "size",
+        which tells the user to try a bigger image file or to break up the text file.
     """
 
-    tk.Tk().withdraw() # we don't want a full GUI, so keep the root window from appearing
     print "Select a Text file"
 
-    textFileName = tkFileDialog.askopenfilename(title = "Select text file",filetypes = (("txt files","*.txt"),("all files","*.*"))) 
+    textFileName = askFileName("Select text file", (("txt files","*.txt"),("all files","*.*")))
     print
     print "Select a Image file"
     
-    imageFileName = tkFileDialog.askopenfilename(title = "Select image file",filetypes = (("png files","*.png"),("all files","*.*")))
+    imageFileName = askFileName("Select image file", (("png files","*.png"),("all files","*.*")))
 
-    runCount = 0
-    waiting, pin = ImageInsert(textFileName, imageFileName, False, '')
-    while waiting == 'deCode' and runCount < 3:
-        waiting, pin = ImageInsert(textFileName, imageFileName, True, pin)
-        runCount += 1
+    waiting = ImageInsert(textFileName, imageFileName)
 
     # Clean up
     
-    cipherFileName = textFileName[:-4] + "_cipher" + textFileName[-4:]    
-    if os.path.exists(cipherFileName):
-        os.remove(cipherFileName)
     #if waiting == "Done":
         #if os.path.exists(textFileName):  <-- displayed in source code for testing purposes
         #    os.remove(textFileName)       <-- displayed in source code for testing purposes
@@ -332,38 +868,17 @@ def setupAndRunExtraction():
     """
 
     print "Select a Image file to pull text out of"
-    tk.Tk().withdraw() # we don't want a full GUI, so keep the root window from appearing
-    imageFileName = tkFileDialog.askopenfilename(title = "Select image file",filetypes = (("png files","*.png"),("all files","*.*")))
+    imageFileName = askFileName("Select image file", (("png files","*.png"),("all files","*.*")))
     
-    invertable = 'f'
-    print 
-    print "Enter a 16 character long pin/password for the text being hidden in the image"
-    
-    while invertable != 't':
-        pin = str(raw_input("> "))
-        if pin == "exit":
-            return "exit"
-        while len(pin) != 16:
-            print
-            print "Wrong length" 
-            print "Please enter a pin that is 16 characters long"
-            pin = str(raw_input("> "))
-
-        pin = [ord(pin[i]) for i in range(16)]
-
-        if keyMod.invertable(pin):
-            print
-            print "This pin will not work"
-            print "Please try another"
-        else:
-            invertable = 't'
+    pin = promptPin()
+    if pin == "exit":
+        return "exit"
 
 
     messageBack = ImageExtract(imageFileName, pin, False)
 
-    # Clean up 1Test.txt
-    if os.path.exists("1Test.txt"):
-        os.remove("1Test.txt")
+    # Nothing else will be unmasked with this pin, so don't leave its matrices in the pin cache
+    keyMod.clearPinCache()
 
     if messageBack == "cleared":
         return "Done"
@@ -432,6 +947,8 @@ def main():
 
         elif waiting == "exit":
             print "Exiting"
+            if tkRoot != None:
+                tkRoot.destroy()
 
         else:
             print
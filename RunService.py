@@ -0,0 +1,460 @@
+# Description
+# A long running local service that hides text files in images and pulls them back out, so callers don't pay for starting
+# Python and importing NumPy, PIL and PyCrypto on every call.
+#
+# Service:
+#   An HTTP server on localhost takes JSON requests, each on its own thread:
+#     POST /insert   {"text": FILE, "cover": FILE, "output": FILE, "pin": PIN, "cipherMode": "cbc", "channelBits": k, "codec": NAME}
+#     POST /extract  {"image": FILE, "output": FILE, "pin": PIN}
+#     GET  /metrics
+#   The file names and the pin are required, the service never decrypts with a pin of its own.
+#   The service reads and writes any file its caller names, so only callers that can read the token file are served:
+#   every start makes a new random token and writes it into --token-file, which only the user running the service can read,
+#   and every request has to carry it in an "Authorization: Bearer TOKEN" header.  Requests must also name the address
+#   the service is bound to in their Host header and send their body as application/json, so a web page can't reach the
+#   service through a cross site form or DNS rebinding even without the token.
+#   Every reply is a JSON object with the job's status code, the same codes the interactive routines give, and its latency.
+#   The LSB and AES work runs in a fixed pool of worker processes that import the heavy libraries once, when the service starts.
+#   At most --queue requests are taken in at a time, any more are turned away straight away with 503 and status "busy",
+#   so a flood of requests can't pile up without end.
+#   A request with a missing or badly typed field is turned away with 400 and status "request".  A job that raises in its worker
+#   is answered with 500 and status "error", and one that takes longer than JOB_TIMEOUT seconds with 504 and status "timeout",
+#   both counted in the metrics like any other status.
+#   /metrics reports the number of requests per status, the requests turned away and the latency percentiles,
+#   along with the pin cache hits, misses, evictions and size added up over the worker processes.
+#   Each worker keeps the pins it was handed in its pin cache, see KeyModifer, and wipes the cache when the service shuts down.
+#
+# Client:
+#   Reads the token from --token-file and the pin from the environment variable named by --pin-env, HIDDEN_PIN by default.
+#   Makes a set of random text files and cover images, then sends insert and extract requests for them from a number of threads at once,
+#   retrying requests that were turned away, checks every extracted text and reports the throughput and latency percentiles.
+#
+# Python 2 has no asyncio, so the front end is a threaded SocketServer in front of the multiprocessing pool.
+#
+# Run with: python RunService.py serve [--port PORT] [--workers N] [--queue N] [--token-file FILE]
+#           python RunService.py client [--port PORT] [--requests N] [--concurrency N] [--token-file FILE] [--pin-env NAME]
+
+
+import argparse
+import BaseHTTPServer
+import binascii
+import collections
+import hmac
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+import RunBatch as batch
+
+
+DEFAULT_PORT = 8642
+
+# Seconds a request waits for its job before it is answered with 504
+JOB_TIMEOUT = 3600
+
+# Number of latencies kept for the percentiles
+LATENCY_WINDOW = 10000
+
+
+def warmWorker():
+    """ Import the heavy libraries in a new worker process before it is handed any work """
+    import KeyModifer
+    import LSBhinding
+    import pycroptoEcrDecr
+    from PIL import Image
+
+    # The pool stops its workers with SIGTERM when the service shuts down
+    signal.signal(signal.SIGTERM, stopWorker)
+
+
+def stopWorker(signum, frame):
+    """ Wipe the pin cache of a worker process being stopped, then end the process """
+    import KeyModifer
+    KeyModifer.clearPinCache()
+    os._exit(0)
+
+
+def runJob(routine, job):
+    """ Run a RunBatch routine in a worker process, returning its result along with the worker's pid and pin cache counters """
+    import KeyModifer
+    return routine(job) + (os.getpid(), KeyModifer.getPinCacheStats())
+
+
+def percentile(values, fraction):
+    """ Value below which the given fraction of the sorted values fall, None when there are no values """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Metrics(object):
+    """ Counts of requests per status and the latencies of the most recent requests, safe to update from many threads """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counts = {}
+        self.rejected = 0
+        self.inFlight = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.workTimes = collections.deque(maxlen=LATENCY_WINDOW)
+        self.pinCaches = {}
+
+    def record(self, status, latency, workTime=None):
+        """ Count a request, workTime is None when the job never reported how long it took """
+        with self.lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+            self.latencies.append(latency)
+            if workTime != None:
+                self.workTimes.append(workTime)
+
+    def recordPinCache(self, pid, stats):
+        """ Keep the latest pin cache counters a worker process reported.
+            Replies can be handled out of order, so counters older than the ones already kept are dropped."""
+        with self.lock:
+            old = self.pinCaches.get(pid)
+            if old == None or stats["hits"] + stats["misses"] >= old["hits"] + old["misses"]:
+                self.pinCaches[pid] = stats
+
+    def snapshot(self):
+        """ Copy of the metrics with the latency percentiles in milliseconds """
+        with self.lock:
+            latencies = sorted(self.latencies)
+            workTimes = sorted(self.workTimes)
+            served = sum(self.counts.values())
+            result = {"counts": dict(self.counts), "rejected": self.rejected, "inFlight": self.inFlight,
+                      "uptime": time.time() - self.started,
+                      "pinCache": dict((name, sum([stats[name] for stats in self.pinCaches.values()]))
+                                       for name in ("hits", "misses", "evictions", "size"))}
+
+        result["requestsPerSecond"] = served / max(result["uptime"], 1e-6)
+        for name, values in (("latency", latencies), ("work", workTimes)):
+            for label, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+                value = percentile(values, fraction)
+                result[name + label] = None if value == None else value * 1000
+        return result
+
+
+def defaultTokenFile(port):
+    """ Token file used for the port when none is named, in the home directory of the user running the service """
+    return os.path.join(os.path.expanduser("~"), ".hidden_service_%d.token" % port)
+
+
+def writeToken(fileName, token):
+    """ Write the token into a new file only this user can read, replacing a token file left behind by an earlier run """
+    if os.path.lexists(fileName):
+        os.remove(fileName)
+    handle = os.open(fileName, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0600)
+    with os.fdopen(handle, "wb") as fOut:
+        fOut.write(token)
+
+
+def readToken(fileName):
+    """ Read the token a running service wrote into its token file """
+    with open(fileName, "rb") as fIn:
+        return fIn.read().strip()
+
+
+class ServiceServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ HTTP server handing every request to its own thread, holding the worker pool, the queue slots, the metrics
+        and the token and Host header values requests have to carry """
+
+    daemon_threads = True
+
+    def __init__(self, address, workers, queueSize, token):
+        # The pool is forked before the listening socket is opened, so the workers don't hold on to it
+        self.pool = multiprocessing.Pool(workers, warmWorker)
+        BaseHTTPServer.HTTPServer.__init__(self, address, ServiceHandler)
+        self.slots = threading.BoundedSemaphore(queueSize)
+        self.metrics = Metrics()
+        self.authorization = "Bearer " + token
+        port = self.server_address[1]
+        self.hosts = ("%s:%d" % (address[0], port), "localhost:%d" % port)
+
+
+class ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Turn each HTTP request into an insert or extract job for the worker pool """
+
+    def do_GET(self):
+        if not self.allowed():
+            return
+        if self.path == "/metrics":
+            self.reply(200, self.server.metrics.snapshot())
+        else:
+            self.reply(404, {"status": "unknown"})
+
+    def do_POST(self):
+        start = time.time()
+        if not self.allowed():
+            return
+        if self.path not in ("/insert", "/extract"):
+            self.reply(404, {"status": "unknown"})
+            return
+
+        # A browser can send text/plain or form bodies to any address without asking first, but not application/json
+        contentType = self.headers.getheader("Content-Type", "").split(";")[0].strip().lower()
+        if contentType != "application/json":
+            self.reply(415, {"status": "request"})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader("Content-Length", 0))))
+            job = self.makeJob(request)
+        except (ValueError, KeyError, TypeError, UnicodeError):
+            self.reply(400, {"status": "request"})
+            return
+        if job["pin"] == None:
+            self.reply(400, {"status": "pin"})
+            return
+
+        # Backpressure: a request that finds every slot taken is turned away instead of waiting
+        metrics = self.server.metrics
+        if not self.server.slots.acquire(False):
+            with metrics.lock:
+                metrics.rejected += 1
+            self.reply(503, {"status": "busy"})
+            return
+
+        with metrics.lock:
+            metrics.inFlight += 1
+        try:
+            routine = batch.runInsert if self.path == "/insert" else batch.runExtract
+            job, status, size, workTime, pid, pinStats = self.server.pool.apply_async(runJob, (routine, job)).get(JOB_TIMEOUT)
+            metrics.recordPinCache(pid, pinStats)
+            code = 200
+        except multiprocessing.TimeoutError:
+            code, status, size, workTime = 504, "timeout", 0, None
+        except Exception:
+            code, status, size, workTime = 500, "error", 0, None
+        finally:
+            with metrics.lock:
+                metrics.inFlight -= 1
+            self.server.slots.release()
+
+        latency = time.time() - start
+        metrics.record(status, latency, workTime)
+        self.reply(code, {"status": status, "bytes": size, "latency": latency, "work": workTime})
+
+    def allowed(self):
+        """ Check the request was sent to the address the service is bound to and carries the token.
+            Returns False, after replying 403, when it doesn't."""
+        if self.headers.getheader("Host") not in self.server.hosts:
+            self.reply(403, {"status": "host"})
+            return False
+        if not hmac.compare_digest(self.headers.getheader("Authorization", ""), self.server.authorization):
+            self.reply(403, {"status": "token"})
+            return False
+        return True
+
+    def makeJob(self, request):
+        """ Build a RunBatch job out of the request, file names are made absolute as the worker may not share our directory.
+            Raises ValueError when a field is missing or isn't of a type and value the routines take."""
+        if not isinstance(request, dict):
+            raise ValueError("The request must be a JSON object")
+
+        pin = None
+        if request.get("pin") != None:
+            pin = batch.checkPin(str(request["pin"]))
+
+        options = {"cipherMode": request.get("cipherMode", batch.AES.CIPHER_CBC),
+                   "channelBits": request.get("channelBits"),
+                   "codec": request.get("codec"),
+                   "paranoid": request.get("paranoid", False)}
+        if options["cipherMode"] not in (batch.AES.CIPHER_CBC, batch.AES.CIPHER_CTR):
+            raise ValueError("Unknown cipher mode")
+        channelBits = options["channelBits"]
+        if channelBits != None and (type(channelBits) != int or not 1 <= channelBits <= 4):
+            raise ValueError("channelBits must be a whole number from 1 to 4")
+        # A codec that isn't installed is the routine's to report, with status "codec"
+        if options["codec"] != None and not isinstance(options["codec"], basestring):
+            raise ValueError("codec must be a codec name")
+        if type(options["paranoid"]) != bool:
+            raise ValueError("paranoid must be true or false")
+        options["cipherMode"] = str(options["cipherMode"])
+        options["codec"] = options["codec"] and str(options["codec"])
+
+        job = {"pin": pin, "options": options}
+        names = ("text", "cover") if self.path == "/insert" else ("image",)
+        for name in names + ("output",):
+            value = request.get(name)
+            if name == "output" and value in (None, ""):
+                continue
+            if not isinstance(value, basestring) or not value:
+                raise ValueError("%s must be a file name" % name)
+            job[name] = os.path.abspath(str(value))
+        return job
+
+    def reply(self, code, body):
+        data = json.dumps(body)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # The metrics take the place of a log line per request
+        pass
+
+
+def serve(port, workers, queueSize, tokenFile):
+    """ Run the service on localhost until it is interrupted, with a new token written into tokenFile """
+    token = binascii.hexlify(os.urandom(32))
+    server = ServiceServer(("127.0.0.1", port), workers, queueSize, token)
+    writeToken(tokenFile, token)
+    print "Serving on 127.0.0.1:%d with %d workers and %d queue slots, token in %s" % (port, workers, queueSize, tokenFile)
+    sys.stdout.flush()
+
+    # Stopping the service with kill shuts it down the same way as Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.terminate()
+        if os.path.exists(tokenFile):
+            os.remove(tokenFile)
+
+
+def post(port, path, request, token):
+    """ Send a JSON request to the service, or a GET when request is None, and return the status code and the JSON reply """
+    headers = {"Authorization": "Bearer " + token}
+    data = None
+    if request != None:
+        headers["Content-Type"] = "application/json"
+        data = json.dumps(request)
+    try:
+        reply = urllib2.urlopen(urllib2.Request("http://127.0.0.1:%d%s" % (port, path), data, headers))
+        return reply.getcode(), json.loads(reply.read())
+    except urllib2.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def runClient(port, requests, concurrency, token, pin, images=4):
+    """ Send requests insert and extract pairs from concurrency threads and check every extracted text.
+        Every request carries the service's token and the pin, given as a 16 character string.
+
+    Returns a dictionary with the number of requests per status, the requests turned away, the wrong texts,
+    the requests per second and the client side latency percentiles in milliseconds.
+    """
+
+    import numpy
+    from PIL import Image
+
+    workDir = tempfile.mkdtemp()
+    texts = []
+    for i in range(images):
+        texts.append(os.urandom(1000 + 700 * i))
+        with open(os.path.join(workDir, "text%d.txt" % i), "wb") as fout:
+            fout.write(texts[-1])
+        Image.fromarray(numpy.random.randint(0, 256, (200, 200, 4)).astype(numpy.uint8), 'RGBA').save(
+            os.path.join(workDir, "cover%d.png" % i))
+
+    lock = threading.Lock()
+    results = {"counts": {}, "busy": 0, "wrong": 0}
+    latencies = []
+    pending = collections.deque(range(requests))
+
+    def send(path, request):
+        """ Send the request, retrying with a growing wait while the service is busy """
+        wait = 0.01
+        while True:
+            start = time.time()
+            request["pin"] = pin
+            code, reply = post(port, path, request, token)
+            if code != 503:
+                with lock:
+                    latencies.append(time.time() - start)
+                    results["counts"][reply["status"]] = results["counts"].get(reply["status"], 0) + 1
+                return reply
+            with lock:
+                results["busy"] += 1
+            time.sleep(wait)
+            wait = min(wait * 2, 1.0)
+
+    def worker():
+        while True:
+            try:
+                number = pending.popleft()
+            except IndexError:
+                return
+            i = number % images
+            image = os.path.join(workDir, "out%d.png" % number)
+            output = os.path.join(workDir, "out%d.txt" % number)
+            send("/insert", {"text": os.path.join(workDir, "text%d.txt" % i), "cover": os.path.join(workDir, "cover%d.png" % i),
+                             "output": image})
+            reply = send("/extract", {"image": image, "output": output})
+            good = reply["status"] == "Done" and open(output, "rb").read() == texts[i]
+            with lock:
+                results["wrong"] += not good
+
+    start = time.time()
+    try:
+        threads = [threading.Thread(target=worker) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        shutil.rmtree(workDir)
+
+    latencies.sort()
+    results["requestsPerSecond"] = len(latencies) / (time.time() - start)
+    for label, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+        value = percentile(latencies, fraction)
+        results[label] = None if value == None else value * 1000
+    return results
+
+
+def main(argv=None):
+    """ Start the service or the load driving client """
+
+    parser = argparse.ArgumentParser(description="Local service hiding text files in images and pulling them back out.")
+    parser.add_argument("role", choices=["serve", "client"])
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--queue", type=int, help="requests taken in at a time, four per worker by default")
+    parser.add_argument("--token-file", help="file the service writes its token into, ~/.hidden_service_PORT.token by default")
+    parser.add_argument("--pin-env", default="HIDDEN_PIN", help="environment variable holding the pin the client sends")
+    parser.add_argument("--requests", type=int, default=200, help="insert and extract pairs the client sends")
+    parser.add_argument("--concurrency", type=int, default=16, help="threads the client sends requests from")
+    args = parser.parse_args(argv)
+
+    tokenFile = args.token_file or defaultTokenFile(args.port)
+    if args.role == "serve":
+        serve(args.port, max(1, args.workers), args.queue or 4 * max(1, args.workers), tokenFile)
+        return 0
+
+    pin = os.environ.get(args.pin_env, "")
+    if batch.checkPin(pin) == None:
+        print "A 16 character long pin that can mask a key is needed in $%s" % args.pin_env
+        return 2
+
+    token = readToken(tokenFile)
+    results = runClient(args.port, args.requests, args.concurrency, token, pin)
+    print "%d insert and extract pairs from %d threads" % (args.requests, args.concurrency)
+    for status in sorted(results["counts"]):
+        print "%-8s %d" % (status, results["counts"][status])
+    print "turned away %d, wrong texts %d" % (results["busy"], results["wrong"])
+    # No latencies when no request got an answer, with zero requests or a service that only turned them away
+    print "%.1f requests/s, latency p50 %s, p90 %s, p99 %s" % tuple(
+        [results["requestsPerSecond"]] + ["n/a" if results[label] == None else "%.1f ms" % results[label]
+                                          for label in ("p50", "p90", "p99")])
+    print "Service metrics: " + json.dumps(post(args.port, "/metrics", None, token)[1])
+    if results["wrong"]:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,19 +3,149 @@
 
 # Description
 # This program is ran once for every new file being encrypted.
-# The purpose of this program is to add one 128 bit block of dead text to the users file.
-# The reason for this is during the decryption process the very first block is not decrypted.
+# The purpose of this program is to check that the users file can be read before any of the encryption work is started.
+#
+# The file used to have one 128 bit block of dead text added to the front of it, as the very first block was never decrypted.
+# The cipher text now carries its own initialization vector, so the users file is only ever opened for reading.
+#
+# Compression:
+# Every byte of cipher text takes up 8 pixel colors of the image, and text files and logs often compress 5-10 times.
+# So the users file can be compressed with zlib, bz2 or lzma before it is encrypted, a block at a time, into memory.
+# The compressed text is never written to disk, as it is just as readable as the users file.  It has to fit the image,
+# which is decoded into memory too, so compressFile gives up as soon as the compressed text grows past the room it is given.
+# pickCodec picks the codec that shrinks the start of the file the most,
+# or none if no codec saves at least a tenth.  DecompressFile undoes the compression while the decrypted text is being written out.
+# lzma is only offered when the lzma module (backports.lzma on Python 2) is installed.
+#
+# Output files:
+# atomicWrite writes a file under a unique temporary name next to it and only moves it into place once it is complete,
+# so runs going on at the same time never write into the same file and nobody ever sees a half written file.
+# The temporary file is created with the same mode open uses, so the finished file gets the same permissions a file made with open
+# would get, without ever reading or changing the process umask while other threads may be making files.
 
-def BufferBlock(fIn):
-    """ Append a buffer block to the file that will be encrypted.
-        This is done do to the very first block of the file not be decrypted."""
-    bufferB = "                "
+import binascii
+import bz2
+import contextlib
+import errno
+import io
+import os
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+# Codec name: (compressor, decompressor)
+CODECS = {"zlib": (lambda: zlib.compressobj(9), zlib.decompressobj),
+          "bz2": (lambda: bz2.BZ2Compressor(9), bz2.BZ2Decompressor)}
+if lzma != None:
+    CODECS["lzma"] = (lzma.LZMACompressor, lzma.LZMADecompressor)
+
+# Number of bytes read and compressed at a time
+COMPRESS_BLOCK_SIZE = 256 << 10
+
+# Number of bytes from the start of the file pickCodec tries each codec on, and the size a codec has to shrink them to
+AUTO_SAMPLE_SIZE = 1 << 20
+AUTO_MIN_RATIO = 0.9
+
+def CheckFile(fIn):
+    """ Check that the file that will be encrypted exists and can be read as bytes."""
     try:
-        with open(fIn, "r") as sFile:
-            originalLine = sFile.read()
-            with open(fIn, "w+") as wsFile:
-                wsFile.write(bufferB + originalLine)
+        with open(fIn, "rb") as sFile:
+            sFile.read(1)
 
         return "g"
     except:
         return "b"
+
+
+def createTemp(directory):
+    """ Create a uniquely named empty file in the directory with the mode open uses, so the umask applies to it the same way.
+        Returns the file descriptor and the file name."""
+    while True:
+        tempName = os.path.join(directory, ".%s.tmp" % binascii.hexlify(os.urandom(8)))
+        try:
+            return os.open(tempName, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0666), tempName
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+
+@contextlib.contextmanager
+def atomicWrite(fileName):
+    """ Open a uniquely named temporary file next to fileName for writing bytes, and move it over fileName when the with block ends.
+        When the with block raises the temporary file is removed and fileName is left as it was."""
+    handle, tempName = createTemp(os.path.dirname(os.path.abspath(fileName)))
+    try:
+        with os.fdopen(handle, "wb") as fOut:
+            yield fOut
+
+        # Windows won't rename over a file that exists
+        if os.name == "nt" and os.path.exists(fileName):
+            os.remove(fileName)
+        os.rename(tempName, fileName)
+    except:
+        if os.path.exists(tempName):
+            os.remove(tempName)
+        raise
+
+
+def pickCodec(fIn):
+    """ Compress the start of the file with every codec and return the name of the one that shrinks it most,
+        or None when no codec shrinks it below AUTO_MIN_RATIO of its size."""
+    with open(fIn, "rb") as sFile:
+        sample = sFile.read(AUTO_SAMPLE_SIZE)
+
+    best = None
+    bestSize = len(sample) * AUTO_MIN_RATIO
+    for codec in sorted(CODECS):
+        compressor = CODECS[codec][0]()
+        size = len(compressor.compress(sample)) + len(compressor.flush())
+        if size < bestSize:
+            best = codec
+            bestSize = size
+    return best
+
+
+def compressFile(fIn, codec, limit=None):
+    """ Compress the file with the named codec a block at a time into memory.
+        Returns a file object over the compressed text, rewound to its start, and the compressed size.
+        When the compressed text grows past limit bytes the compression stops and None is returned along with the size so far."""
+    compressor = CODECS[codec][0]()
+    fOut = io.BytesIO()
+    with open(fIn, "rb") as sFile:
+        for block in iter(lambda: sFile.read(COMPRESS_BLOCK_SIZE), ''):
+            fOut.write(compressor.compress(block))
+            if limit != None and fOut.tell() > limit:
+                return None, fOut.tell()
+    fOut.write(compressor.flush())
+
+    size = fOut.tell()
+    fOut.seek(0)
+    return fOut, size
+
+
+class DecompressFile(object):
+    """ File object that decompresses everything written to it with the named codec into the file object fOut """
+
+    def __init__(self, fOut, codec):
+        self.fOut = fOut
+        self.decompressor = CODECS[codec][1]()
+
+    def write(self, data):
+        # A decompressor that has reached the end of its stream, as bz2 does, raises on any more input, even an empty string
+        if len(data) == 0:
+            return
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        self.fOut.write(self.decompressor.decompress(data))
+
+    def finish(self):
+        """ Write out whatever the decompressor still holds, fOut is left open """
+        if hasattr(self.decompressor, "flush"):
+            self.fOut.write(self.decompressor.flush())
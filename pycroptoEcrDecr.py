@@ -3,6 +3,8 @@
 
 # Description
 # This program has two pieces: a file encryption piece and a file decryption piece.
+# The encryption piece can also hand the cipher text back one block at a time, so it can be fed straight into the image without a cipher file.
+# The decryption piece works the same way in reverse, decrypting cipher text as it comes out of the image and writing the clean text as it goes.
 # The encryption and decryption is done with AES in CBC mode from the python library PyCrypto.
 # This program is the second step of the encryption phase and the last step of the decryption phase in the main routine.
 # The interaction between the file and AES comes from the online written tutorial by Jay Sridar.
@@ -12,100 +14,313 @@
 # The key in ascii form is instantly used for the encryption of the file.
 # The key in numeric list form is "masked" by KeyModifer.py for long term storage.  
 # 
+# Cipher text format:
+# The cipher text starts with a 20 byte header, the magic string "HEC", the format version and the 16 byte initialization vector.
+# The clean text is padded to a multiple of 16 with PKCS#7 padding, every padding byte holds the number of padding bytes, 
+# so the exact clean text comes back out of any file, text or binary.
+# Older cipher text has no header.  Its first 16 bytes were used as the IV, which is why a block of spaces used to be put in front of 
+# the clean text, and its padding is removed by the clean text file size.  Cipher text without the header is decrypted that way.
+#
+# CTR mode:
+# CBC encryption can't be split up, every block depends on the one before it.  In CTR mode block i is the clean text XORed with the 
+# encryption of nonce + counter i, so every segment of the file can be handled on its own once its first counter value is known.
+# CTR cipher text starts with a 12 byte header, the magic string "HEC", version 2 and the 8 byte nonce, and needs no padding.
+# Segments are handed to a pool of worker processes and put back in order, with only a few segments per worker in flight at a time.
+#
+# Files are read with readinto into one bytearray that is reused for every block, and AES writes the cipher text into a second reused bytearray,
+# so no new strings are made per block.  Large block sizes keep the time spent in Python small next to the time spent in AES.
 #
 # Sridhar, Jay. "Using AES for Encryption and Decryption in Python Pycrypto." Novixys Software 
 # Dev Blog, 8 Feb. 2018, https://www.novixys.com/blog/using-aes-encryption-decryption-python-pycrypto/.
 
-import os, random, struct
+import collections, io, itertools, multiprocessing, os
 from Crypto.Cipher import AES
-from Crypto import Random
 
 
-def encrypt(infile, encfile, sz, key):
-    """ With AES encryption in CBC mode, encrypt the provided file.
+CIPHER_MAGIC = 'HEC'
+CIPHER_VERSION = 1
+CIPHER_HEADER_SIZE = len(CIPHER_MAGIC) + 1 + 16
+
+# Cipher modes, CBC is serial while CTR segments can be encrypted and decrypted on separate cores
+CIPHER_CBC = 'cbc'
+CIPHER_CTR = 'ctr'
+CTR_VERSION = 2
+CTR_HEADER_SIZE = len(CIPHER_MAGIC) + 1 + 8
+DEFAULT_WORKERS = multiprocessing.cpu_count()
+
+# Number of bytes read and encrypted at a time, picked with "python RunBenchmarks.py aes"
+DEFAULT_BLOCK_SIZE = 256 << 10
+
+
+def encrypt(infile, encfile, sz, key, mode=CIPHER_CBC, workers=1):
+    """ With AES encryption in CBC (or CTR) mode, encrypt the provided file into a cipher file. """
+
+    with open(encfile, 'wb') as fout:
+        for encd in encryptStream(infile, sz, key, mode, workers):
+            fout.write(encd)
+
+
+def encryptStream(infile, sz, key, mode=CIPHER_CBC, workers=1):
+    """ With AES encryption in CBC mode, encrypt the provided file one block at a time.
+        With mode CIPHER_CTR the file is encrypted in CTR mode by encryptSegments instead, using up to workers processes.
     
     Steps:
     1) Setup AES for encryption:
-        - Initialize AES with a 16 ascii character initialization vector and the provided key
+        - Initialize AES with a random 16 byte initialization vector and the provided key
+        - Open the provided file, it is only ever read
         
-    2) Encrypt the provided file:
-        - Open the provided text file and create the cipher file.
-        - Read the clean text file in blocks on size sz
-            - test that the size of the block read in is a multiple of 16, pad with white space otherwise
-        - Encrypt the block and write the cipher text to the cipher file 
+    2) Hand back a generator that encrypts the provided file:
+        - Hand the header with the IV to the caller first
+        - Read the clean file into a reused buffer in blocks of size sz, rounded down to a multiple of 16
+        - Encrypt each full block into a second reused buffer and hand it to the caller.
+          The buffer is overwritten by the next block, so it must be used or copied before asking for the next one.
+        - Pad the last bytes with PKCS#7 padding and encrypt them
         """
 
+    if mode == CIPHER_CTR:
+        return encryptSegments(infile, sz, key, workers)
+    elif mode != CIPHER_CBC:
+        raise ValueError("Unknown cipher mode: " + str(mode))
+
     # 1)
     # ---------------------------------------------------------------------------------------------
-    iv = ''.join([chr(random.randint(0, 0xFF)) for i in range(16)])
+    iv = os.urandom(16)
     aes = AES.new(key, AES.MODE_CBC, iv)
+    blockSize = max(16, sz - sz % 16)
+
+    # Both files must be in byte read/write mode
+    fin = openInput(infile)
 
     # 2)
     # ---------------------------------------------------------------------------------------------
+    def encryptBlocks():
+        inBuffer = bytearray(blockSize)
+        outBuffer = bytearray(blockSize)
+        inView = memoryview(inBuffer)
 
-    # Both files must be in byte read/write mode
-    with open(encfile, 'wb') as fout:
-        with open(infile, "rb") as fin:
+        with fin:
+            yield CIPHER_MAGIC + chr(CIPHER_VERSION) + iv
+
+            filled = 0
             while True:
                 
-                # Read in one block of data from the text file at a time
-                # This is not the AES encryption block size, but the size of block that will be encrypted
-                # We break the file read into blocks as AES encryption requires each block being encrypted to be a multiple of 16
-                data = fin.read(sz)
-                n = len(data)
-                if n == 0:
+                # Fill the block buffer from the file, a read can come back short before the end of the file
+                n = fin.readinto(inView[filled:])
+                if not n:
                     break
-                elif n % 16 != 0:
-                    data += ' ' * (16 - n % 16) # <- padded the block with spaces to by 16 chars
-                
-                encd = aes.encrypt(data)
-                fout.write(encd)
+                filled += n
+
+                if filled == blockSize:
+                    aes.encrypt(inBuffer, output=outBuffer)
+                    yield outBuffer
+                    filled = 0
+
+            padding = 16 - filled % 16
+            yield aes.encrypt(str(inBuffer[:filled]) + chr(padding) * padding) # <- pad the last block to 16 bytes
+
+    return encryptBlocks()
+
+
+def encryptSegments(infile, sz, key, workers):
+    """ With AES encryption in CTR mode, encrypt the provided file one segment of size sz at a time, rounded down to a multiple of 16.
+        The segments are encrypted by up to workers processes and handed back in order, after the header with the nonce.
+    """
+
+    nonce = os.urandom(8)
+    blockSize = max(16, sz - sz % 16)
+    fin = openInput(infile)
+
+    def encryptBlocks():
+        with fin:
+            yield CIPHER_MAGIC + chr(CTR_VERSION) + nonce
+            for encd in runSegments(key, nonce, iter(lambda: fin.read(blockSize), ''), workers):
+                yield encd
+
+    return encryptBlocks()
+
+
+def openInput(infile):
+    """ Open the file to be encrypted for reading bytes, a file object that is already open is used as it is and closed once encrypted """
+    if hasattr(infile, "read"):
+        return infile
+    return io.open(infile, "rb")
+
+
+def ctrSegment(job):
+    """ Encrypt or decrypt one segment in CTR mode, starting at counter value firstBlock.  This runs inside the worker processes. """
+    key, nonce, firstBlock, data = job
+    return AES.new(key, AES.MODE_CTR, nonce=nonce, initial_value=firstBlock).encrypt(data)
+
+
+def runSegments(key, nonce, segments, workers):
+    """ Run every segment through CTR mode in order and hand back the results in the same order.
+
+    Every segment but the last must be a multiple of 16 bytes long, so the counter value of each segment follows from the lengths before it.
+    With more than one worker the segments are handed to a process pool, keeping two segments per worker in flight.
+    """
 
-    fout.close()
-    fin.close()
+    firstBlock = 0
+    if workers <= 1:
+        for data in segments:
+            yield ctrSegment((key, nonce, firstBlock, data))
+            firstBlock += len(data) // 16
+        return
 
+    pool = multiprocessing.Pool(workers)
+    try:
+        inFlight = collections.deque()
+        for data in segments:
+            inFlight.append(pool.apply_async(ctrSegment, ((key, nonce, firstBlock, data),)))
+            firstBlock += len(data) // 16
+            if len(inFlight) >= 2 * workers:
+                yield inFlight.popleft().get()
+        while inFlight:
+            yield inFlight.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
 
-def decrypt(encfile, verfile, key, sz, fsz):
-    """ Decrypted the given cipher file using AES in CBC mode.
+
+def segmentChunks(chunks, size):
+    """ Regroup chunks of any size into segments of size bytes, the last segment holds whatever is left """
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        while len(pending) >= size:
+            yield str(pending[:size])
+            del pending[:size]
+    if pending:
+        yield str(pending)
+
+
+def cipherLength(size, mode=CIPHER_CBC):
+    """ Number of cipher text bytes encrypt and encryptStream make out of a file of size bytes """
+    if mode == CIPHER_CTR:
+        return CTR_HEADER_SIZE + size
+    return CIPHER_HEADER_SIZE + (size // 16 + 1) * 16
+
+
+def decrypt(encfile, verfile, key, sz, fsz, workers=1):
+    """ Decrypted the given cipher file using AES in CBC (or CTR) mode into a clean text file. """
+
+    # Open the cipher file in byte read mode, byte read/write mode is crucial to the functionality of the AES library
+    with open(encfile, "rb") as fin:
+        with open(verfile, 'wb') as fout:
+            decryptStream(iter(lambda: fin.read(sz), ''), key, fout, fsz, workers)
+
+
+def decryptStream(cipherChunks, key, fout, fsz, workers=1):
+    """ Decrypt cipher text handed over in chunks of any size, writing the clean text to the file object fout.
+        The cipher mode is picked from the cipher text's header.
+    """
+
+    # Gather enough cipher text to tell the headers apart
+    cipherChunks = iter(cipherChunks)
+    head = bytearray()
+    for chunk in cipherChunks:
+        head += chunk
+        if len(head) >= CIPHER_HEADER_SIZE:
+            break
+
+    cipherChunks = itertools.chain([head], cipherChunks)
+    if head[:len(CIPHER_MAGIC) + 1] == CIPHER_MAGIC + chr(CTR_VERSION):
+        decryptSegments(cipherChunks, key, fout, workers)
+    else:
+        decryptBlocks(cipherChunks, key, fout, fsz)
+
+
+def decryptSegments(cipherChunks, key, fout, workers):
+    """ Decrypt CTR mode cipher text handed over in chunks of any size, using up to workers processes, writing the clean text to fout. """
+
+    cipherChunks = iter(cipherChunks)
+    header = bytearray()
+    for chunk in cipherChunks:
+        header += chunk
+        if len(header) >= CTR_HEADER_SIZE:
+            break
+    if len(header) < CTR_HEADER_SIZE:
+        raise ValueError("Cipher text is too short")
+
+    nonce = str(header[len(CIPHER_MAGIC) + 1:CTR_HEADER_SIZE])
+    segments = segmentChunks(itertools.chain([header[CTR_HEADER_SIZE:]], cipherChunks), DEFAULT_BLOCK_SIZE)
+    for decd in runSegments(key, nonce, segments, workers):
+        fout.write(decd)
+
+
+def decryptBlocks(cipherChunks, key, fout, fsz):
+    """ Decrypt cipher text handed over in chunks of any size using AES in CBC mode, writing the clean text to the file object fout.
     
     Steps:
     1) Set up AES for decryption:
-        - Open provided cipher file and pull the initialization vector from the start of the first line. 
-        - Then initialize AES in CBC mode with the IV pulled from the file.
+        - When the cipher text starts with the header, pull the initialization vector out of the header.
+        - Older cipher text has no header, pull the initialization vector from the first 16 bytes of cipher text. 
+        - Then initialize AES in CBC mode with the IV.
     
-    2) Decrypt the Provided cipher file:
-        - Create and open a clean text file. 
-        - Then read in the cipher text in blocks of size sz:
-            - Decrypt each block
-            - Write the clean text into the the created file
-        - Remove the padding from the last deciphered block based on the original clean text file size.
+    2) Decrypt the cipher text as it comes in:
+        - Decrypt every whole 16 byte block that has arrived into a reused buffer and write the clean text to fout right away,
+          only a partial block is held back until the next chunk arrives.
+        - With the header the last block is held back as well, once all of the cipher text is in its PKCS#7 padding is removed.
+        - Without the header the padding is removed from the last deciphered block based on the original clean text file size fsz.
     """
 
-    # 1)
-    # ---------------------------------------------------------------------------------------------
+    pending = bytearray()
+    outBuffer = bytearray()
+    aes = None
+    padded = False
+    lastBlock = ''
 
-    # Open the cipher file in byte read mode, byte read/write mode is crucial to the functionality of the AES library
-    with open(encfile, "rb") as fin:
-        iv = fin.read(16)
-        aes = AES.new(key, AES.MODE_CBC, iv)
+    for chunk in cipherChunks:
+        pending += chunk
+
+        # 1)
+        # ---------------------------------------------------------------------------------------------
+        if aes == None:
+            if len(pending) < CIPHER_HEADER_SIZE:
+                continue
+            start = 0
+            if pending[:len(CIPHER_MAGIC) + 1] == CIPHER_MAGIC + chr(CIPHER_VERSION):
+                padded = True
+                start = len(CIPHER_MAGIC) + 1
+            aes = AES.new(key, AES.MODE_CBC, str(pending[start:start + 16]))
+            del pending[:start + 16]
 
         # 2)
         # ---------------------------------------------------------------------------------------------
-        with open(verfile, 'wb') as fout:
-            while True:
-                data = fin.read(sz)
-                n = len(data)
-                if n == 0:
-                    break
-                decd = aes.decrypt(data)
-                n = len(decd)
-                if fsz > n:
-                    fout.write(decd)
-                else:
-                    fout.write(decd[:fsz]) # <- remove padding on last block
-                fsz -= n
-    fout.close()
-    fin.close()
+        n = len(pending) - len(pending) % 16
+        if n == 0:
+            continue
+        if len(outBuffer) < n:
+            outBuffer = bytearray(n)
+        decd = memoryview(outBuffer)[:n]
+        aes.decrypt(memoryview(pending)[:n], output=decd)
+        del pending[:n]
+
+        if padded:
+            if lastBlock:
+                fout.write(lastBlock)
+            if n > 16:
+                fout.write(decd[:-16])
+            lastBlock = decd[-16:].tobytes()
+        elif fsz > n:
+            fout.write(decd)
+        else:
+            fout.write(decd[:fsz]) # <- remove padding on last block
+        fsz -= n
+
+    if pending:
+        raise ValueError("Cipher text length must be a multiple of 16")
+
+    if aes == None:
+        raise ValueError("Cipher text is too short")
+
+    if padded:
+        padding = ord(lastBlock[-1:] or '\x00')
+        if padding < 1 or padding > 16 or lastBlock[-padding:] != chr(padding) * padding:
+            raise ValueError("Padding is incorrect")
+
+        # A clean text that is a multiple of 16 bytes ends with a whole block of padding, which leaves nothing to write
+        if padding < 16:
+            fout.write(lastBlock[:-padding])
 
 
 def generateKey():